@@ -7,15 +7,17 @@ Email: iheredia@ifca.unican.es
 Github: ignacioheredia
 """
 
-import io
 import os
 import pkg_resources
 import json
 import builtins
 import mimetypes
 from collections import OrderedDict
+from contextlib import contextmanager
+import copy
 from datetime import datetime
 import shutil
+import threading
 
 import requests
 from webargs import fields, validate
@@ -23,8 +25,26 @@ from aiohttp.web import HTTPBadRequest
 
 from satsr import config, paths, main_sat
 from satsr.train_runfile import train_fn
-from satsr.test_runfile import test, load_models
-from satsr.utils import misc
+from satsr.test_runfile import test, load_models, model_cache, get_sr_resolutions, get_output_path
+from satsr.utils import misc, result_cache, tile_cache, runtime_utils
+from satsr.utils.job_queue import JobQueue
+
+
+# Batch prediction jobs run in the background
+job_queue = JobQueue(workers=config.conf_dict['runtime']['batch_workers'])
+
+# The configuration, the functions of the selected satellite, the resident models and the runtime profile are shared
+# by the whole process, so the code depending on them (training and the super-resolution of the synchronous requests
+# and of the tasks of batch jobs) runs one request at a time. Downloads and extractions still run concurrently.
+conf_lock = threading.RLock()
+
+# Testing options only available when calling `test()` locally, as their outputs reference files of the server
+local_only_keys = ['original_bands_vrt']
+
+# Media types of the responses: super-resolved tiles, outputs of the batch jobs and job submissions and statuses
+media_types = {'output': 'image/tiff',
+               'job_result': 'application/x-tar',
+               'job_info': 'application/json'}
 
 
 # FIXME: There is a memory leak? --> outputs should be periodically cleared
@@ -55,35 +75,82 @@ def update_user_conf(user_args):
     config.conf_dict = config.get_conf_dict(conf=CONF)
 
 
+def get_request_conf(user_args):
+    """
+    Update the configuration with the user's input and return a copy of it, which is used for the rest of the request
+    """
+    with conf_lock:
+        update_user_conf(user_args=user_args)
+        return copy.deepcopy(config.conf_dict)
+
+
+@contextmanager
+def use_conf(conf_dict):
+    """
+    Run a block of code with the configuration of a request, without other request changing it meanwhile
+    """
+    with conf_lock:
+        previous, config.conf_dict = config.conf_dict, conf_dict
+        try:
+            yield
+        finally:
+            config.conf_dict = previous
+
+
 def warm():
-    load_models()
+    # Only the models needed by the default configuration are loaded (and only if asked to), the rest are loaded
+    # the first time a prediction needs them
+    if config.conf_dict['runtime']['preload_models']:
+        load_models(max_res=config.conf_dict['testing']['max_res_test'], background=True)
 
 
 def train(**args):
     """
     Train a super-resolution model
     """
-    update_user_conf(user_args=args)
-    CONF = config.conf_dict
-    TIMESTAMP = datetime.now().strftime('%Y-%m-%d_%H%M%S')
-
-    if CONF['training']['max_res'] is None:
-        # Train one model for each possible resolution to super-resolve in the satellite
-        resolutions = main_sat.res_to_bands().keys()
-        min_res = min(resolutions)
-        train_res = [res for res in resolutions if res != min_res]
-        for res in train_res:
-            timestamp = TIMESTAMP + '_model_{}m'.format(res)
-            CONF['training']['max_res'] = res
-            train_fn(TIMESTAMP=timestamp, CONF=CONF)
-
-    else:
-        train_fn(TIMESTAMP=TIMESTAMP, CONF=CONF)
+    with conf_lock:
+        update_user_conf(user_args=args)
+        CONF = config.conf_dict
+        TIMESTAMP = datetime.now().strftime('%Y-%m-%d_%H%M%S')
+
+        if CONF['training']['max_res'] is None:
+            # Train one model for each possible resolution to super-resolve in the satellite
+            resolutions = main_sat.res_to_bands().keys()
+            min_res = min(resolutions)
+            train_res = [res for res in resolutions if res != min_res]
+            for res in train_res:
+                timestamp = TIMESTAMP + '_model_{}m'.format(res)
+                CONF['training']['max_res'] = res
+                train_fn(TIMESTAMP=timestamp, CONF=CONF)
+
+        else:
+            train_fn(TIMESTAMP=TIMESTAMP, CONF=CONF)
+
+
+def check_accept(accept, reply):
+    """
+    Check that the media type requested for the response matches the kind of reply (one of `media_types`). Replies
+    that are dicts are returned as JSON so they also accept any media type.
+    """
+    allowed = [media_types[reply]] + (['*/*'] if reply == 'job_info' else [])
+    if accept is not None and accept not in allowed:
+        raise HTTPBadRequest(reason="This request returns '{}', but '{}' was requested as accept media "
+                                    "type".format(media_types[reply], accept))
 
 
 # @catch_error
 def predict(**args):
 
+    # Batch jobs
+    conf_dict = get_request_conf(user_args=args)
+    conf = conf_dict['testing']
+    if conf['job_id']:
+        check_accept(args.get('accept'), reply='job_result' if conf['job_action'] == 'result' else 'job_info')
+        return get_job(job_id=conf['job_id'], action=conf['job_action'])
+    if conf['batch_jobs']:
+        check_accept(args.get('accept'), reply='job_info')
+        return submit_job(tasks=conf['batch_jobs'], conf_dict=conf_dict)
+
     if (not any([args['urls'], args['files']]) or
             all([args['urls'], args['files']])):
         raise Exception("You must provide either 'url' or 'data' in the payload")
@@ -96,68 +163,247 @@ def predict(**args):
         return predict_url(args)
 
 
+def submit_job(tasks, conf_dict):
+    """
+    Queue a batch job to super-resolve several tiles hosted on the web in the background
+
+    Parameters
+    ----------
+    tasks : list
+        Urls of the tiles, or dicts with the `url` of a tile and optionally its `roi_x_y` or `roi_lon_lat` (which
+        override the ones of the configuration for that tile)
+    conf_dict : dict
+        Configuration of the request submitting the job, used by all its tasks
+
+    Returns
+    -------
+    Dict with the id of the job
+    """
+    if not isinstance(tasks, list) or not tasks:
+        raise HTTPBadRequest(reason="A batch job must be a non-empty list of tiles")
+    tasks = [{'url': task} if isinstance(task, str) else task for task in tasks]
+    for task in tasks:
+        if not isinstance(task, dict) or 'url' not in task:
+            raise HTTPBadRequest(reason="Each task of a batch job must be an url or a dict with an 'url'")
+        if set(task.keys()) - {'url', 'roi_x_y', 'roi_lon_lat'}:
+            raise HTTPBadRequest(reason="Invalid keys in task {}. Valid keys are: 'url', 'roi_x_y', "
+                                        "'roi_lon_lat'".format(task))
+
+    # The tasks run with the configuration of the request that submitted the job, whatever the later requests
+    conf_dict = copy.deepcopy(conf_dict)
+    conf_dict['testing']['job_id'], conf_dict['testing']['batch_jobs'] = None, None
+
+    def run_task(task, output_root):
+        tmp_conf = copy.deepcopy(conf_dict)
+        if 'roi_x_y' in task or 'roi_lon_lat' in task:
+            tmp_conf['testing']['roi_x_y_test'] = task.get('roi_x_y')
+            tmp_conf['testing']['roi_lon_lat_test'] = task.get('roi_lon_lat')
+        tmp_conf['testing']['output_path'] = output_root + '.tif'
+        output_path = process_url(task['url'], conf_dict=tmp_conf)
+        if os.path.isdir(os.path.splitext(output_path)[0]):  # chunked array store packed into a tar
+            shutil.rmtree(os.path.splitext(output_path)[0])
+        return output_path
+
+    return {'job_id': job_queue.submit(tasks, run_fn=run_task)}
+
+
+def get_job(job_id, action='status'):
+    """
+    Status of a batch job, or a tar file with its outputs if `action='result'`
+    """
+    if action not in ['status', 'result']:
+        raise HTTPBadRequest(reason="Invalid job action '{}'. Valid actions are: 'status', 'result'".format(action))
+    try:
+        info = job_queue.status(job_id)
+    except KeyError:
+        raise HTTPBadRequest(reason='Unknown job id: {}'.format(job_id))
+    if action == 'status':
+        return info
+    if info['finished'] is None:
+        raise HTTPBadRequest(reason='Job {} is not finished yet ({})'.format(job_id, info['progress']))
+    return open(job_queue.result(job_id), 'rb')
+
+
 def predict_url(args):
     """
     Perform super-resolution on a satellite tile hosted on the web
     """
-    update_user_conf(user_args=args)
-    conf = config.conf_dict['testing']
+    conf_dict = get_request_conf(user_args=args)
+    return open(process_url(args['urls'][0], conf_dict=conf_dict), 'rb')
+
+
+def process_url(url, conf_dict=None):
+    """
+    Download a compressed satellite tile, super-resolve it and return the path of the output file.
+
+    Parameters
+    ----------
+    url : str
+    conf_dict : dict
+        Configuration of the request (by default the current one)
+    """
+    if conf_dict is None:
+        with conf_lock:
+            conf_dict = copy.deepcopy(config.conf_dict)
 
     # Use a compressed file hosted on the web
-    url = args['urls'][0]
     resp = requests.get(url, stream=True, allow_redirects=True)
 
     file_format = mimetypes.guess_extension(resp.headers['content-type'])[1:]
     if file_format is None:
         file_format = os.path.splitext(resp.headers['X-Object-Meta-Orig-Filename'])[1][1:]
 
-    # Download and extract the compressed file
+    # Skip the download if the tile of this url is already cached
+    conf = conf_dict['testing']
+    if conf['tile_cache_size']:
+        checksum = tile_cache.lookup_url(url, headers=resp.headers)
+        if checksum is not None:
+            print('Using the cached tile ...')
+            resp.close()
+            try:
+                return process_archive(byte_stream=None, file_format=file_format, checksum=checksum,
+                                       conf_dict=conf_dict)
+            except tile_cache.TileNotCached:  # removed from the cache meanwhile
+                print('The cached tile has been removed, downloading it again ...')
+                resp = requests.get(url, stream=True, allow_redirects=True)
+
+    # Download the compressed file, streaming it to disk
     print('Downloading the file ...')
-    tile_path = misc.open_compressed(byte_stream=io.BytesIO(resp.raw.read()),
-                                     file_format=file_format,
-                                     output_folder=os.path.join(paths.get_test_dir(), 'sat_tiles'))
-
-    # Predict and save the output
-    try:
-        output_path = test(tile_path=tile_path,
-                           output_path=conf['output_path'],
-                           roi_x_y=conf['roi_x_y_test'],
-                           roi_lon_lat=conf['roi_lon_lat_test'],
-                           max_res=conf['max_res_test'],
-                           copy_original_bands=conf['copy_original_bands'],
-                           output_file_format=conf['output_file_format'])
-    finally:
-        shutil.rmtree(tile_path, ignore_errors=True)
-
-    return open(output_path, 'rb')
+    byte_stream, checksum = misc.download_to_file(resp,
+                                                  max_size=conf['max_download_size'],
+                                                  progress_fn=misc.print_progress(),
+                                                  tmp_dir=os.path.join(paths.get_test_dir(), 'downloads'))
+    with byte_stream:
+        if conf['tile_cache_size']:
+            tile_cache.register_url(url, headers=resp.headers, checksum=checksum)
+        return process_archive(byte_stream=byte_stream, file_format=file_format, checksum=checksum,
+                               conf_dict=conf_dict)
 
 
 def predict_data(args):
     """
     Perform super-resolution on a satellite tile
     """
-    update_user_conf(user_args=args)
-    conf = config.conf_dict['testing']
+    conf_dict = get_request_conf(user_args=args)
 
     # Process data stream of bytes
     file_format = mimetypes.guess_extension(args['files'][0].content_type)[1:]
-    tile_path = misc.open_compressed(byte_stream=open(args['files'][0].filename, 'rb'),
-                                     file_format=file_format,
-                                     output_folder=os.path.join(paths.get_test_dir(), 'sat_tiles'))
+    with open(args['files'][0].filename, 'rb') as byte_stream:
+        return predict_archive(byte_stream=byte_stream, file_format=file_format, conf_dict=conf_dict)
+
+
+def get_result_key(archive_checksum, conf_dict=None):
+    """
+    Key of the output of a request in the result cache: it depends on the input archive, the parameters that change
+    the output and the weights of the models used.
+    """
+    conf = config.conf_dict if conf_dict is None else conf_dict
+    params = {k: conf['testing'][k] for k in ['roi_x_y_test', 'roi_lon_lat_test', 'trim_roi_test', 'max_res_test',
+                                               'copy_original_bands', 'output_file_format', 'output_dtype',
+                                               'output_compression', 'output_tiled', 'precision_test',
+                                               'window_size_test', 'original_bands_vrt']}
+    sr_resolutions = get_sr_resolutions(conf['testing']['max_res_test'])
+    profile = runtime_utils.get_runtime_profile(conf=conf)
+    params.update({'satellite': conf['general']['satellite'],
+                   'frozen_models': [runtime_utils.get_model_profile(profile, res)['frozen_models']
+                                     for res in sr_resolutions]})
+    modelnames = ['{}_model_{}m'.format(conf['general']['satellite'], res) for res in sr_resolutions]
+    return result_cache.get_key(archive_checksum=archive_checksum, params=params, modelnames=modelnames)
+
+
+def predict_archive(byte_stream, file_format, checksum=None, conf_dict=None):
+    """
+    Extract a compressed satellite tile, super-resolve it and return the output file (see `process_archive()`)
+    """
+    return open(process_archive(byte_stream=byte_stream, file_format=file_format, checksum=checksum,
+                                conf_dict=conf_dict), 'rb')
+
+
+def process_archive(byte_stream, file_format, checksum=None, conf_dict=None):
+    """
+    Extract a compressed satellite tile, super-resolve it and return the path of the output file. Outputs and extracted
+    tiles are cached, so that repeated requests are answered without processing the tile again.
+
+    Parameters
+    ----------
+    byte_stream : BinaryIO
+        Compressed tile. It can be None if the tile is in the tile cache.
+    file_format : str
+    checksum : str
+        Checksum of the compressed tile (computed from the stream if not provided)
+    conf_dict : dict
+        Configuration of the request (by default the current one)
+    """
+    if conf_dict is None:
+        with conf_lock:
+            conf_dict = copy.deepcopy(config.conf_dict)
+    conf = conf_dict['testing']
+    if checksum is None and (conf['result_cache_size'] or conf['tile_cache_size']):
+        checksum = misc.stream_checksum(byte_stream)
+
+    # Look for the output in the cache
+    if conf['result_cache_size']:
+        with use_conf(conf_dict):
+            key = get_result_key(archive_checksum=checksum, conf_dict=conf_dict)
+        cached_path = result_cache.lookup(key)
+        if cached_path is not None:
+            print('Returning cached output ...')
+            if conf['output_path']:  # same name as when the output is computed
+                output_file_format, output_path = get_output_path(conf['output_path'], conf['output_file_format'])
+                if output_file_format == 'chunked':
+                    output_path += '.tar'
+                shutil.copyfile(cached_path, output_path)
+                return output_path
+            return cached_path
+
+    # Extract the compressed file (or get it from the tile cache)
+    if conf['tile_cache_size']:
+        tile_path = tile_cache.get_tile(byte_stream=byte_stream, file_format=file_format, checksum=checksum,
+                                        max_size=conf['tile_cache_size'])
+    else:
+        tile_path = misc.open_compressed(byte_stream=byte_stream,
+                                         file_format=file_format,
+                                         output_folder=os.path.join(paths.get_test_dir(), 'sat_tiles'))
 
     # Predict and save the output
     try:
-        output_path = test(tile_path=tile_path,
-                           output_path=conf['output_path'],
-                           roi_x_y=conf['roi_x_y_test'],
-                           roi_lon_lat=conf['roi_lon_lat_test'],
-                           max_res=conf['max_res_test'],
-                           copy_original_bands=conf['copy_original_bands'],
-                           output_file_format=conf['output_file_format'])
+        with use_conf(conf_dict):
+            bands_dir = None
+            if conf['tile_cache_size'] and conf['tile_cache_decoded']:
+                bands_dir = tile_cache.get_bands_dir(tile_path, max_size=conf['tile_cache_size'])
+            output_path = test(tile_path=tile_path,
+                               output_path=conf['output_path'],
+                               roi_x_y=conf['roi_x_y_test'],
+                               roi_lon_lat=conf['roi_lon_lat_test'],
+                               trim_roi=conf['trim_roi_test'],
+                               max_res=conf['max_res_test'],
+                               copy_original_bands=conf['copy_original_bands'],
+                               output_file_format=conf['output_file_format'],
+                               window_size=conf['window_size_test'],
+                               batch_size=conf['batch_size_test'],
+                               memory_budget=conf['memory_budget_test'],
+                               prefetch_workers=conf['prefetch_workers_test'],
+                               num_processes=conf['num_processes_test'],
+                               precision=conf['precision_test'],
+                               bands_dir=bands_dir,
+                               output_dtype=conf['output_dtype'],
+                               output_compression=conf['output_compression'],
+                               output_tiled=conf['output_tiled'],
+                               output_threads=conf['output_threads'])
     finally:
-        shutil.rmtree(tile_path, ignore_errors=True)
+        if conf['tile_cache_size']:
+            tile_cache.release_tile(checksum)
+        else:
+            shutil.rmtree(tile_path, ignore_errors=True)
 
-    return open(output_path, 'rb')
+    # Directory outputs (chunked array stores) are packed into a single file
+    if os.path.isdir(output_path):
+        output_path = shutil.make_archive(output_path, 'tar', root_dir=output_path)
+
+    if conf['result_cache_size']:
+        result_cache.store(key, output_path=output_path, max_size=conf['result_cache_size'])
+
+    return output_path
 
 
 def populate_parser(parser, default_conf):
@@ -206,7 +452,8 @@ def get_predict_args():
     parser = OrderedDict()
     default_conf = config.CONF
     default_conf = OrderedDict([('general', default_conf['general']),
-                                ('testing', default_conf['testing'])])
+                                ('testing', OrderedDict((k, v) for k, v in default_conf['testing'].items()
+                                                        if k not in local_only_keys))])
 
     # Add data and url fields
     parser['files'] = fields.Field(required=False,
@@ -221,9 +468,11 @@ def get_predict_args():
                                 description="Select an URL of the file you want to classify.")
     # missing action="append" --> append more than one url
 
-    # Add format type of the response
+    # Add format type of the response (the first one is the default). Use `application/json` to submit batch jobs and
+    # get their status, and `application/x-tar` to get their outputs.
     parser['accept'] = fields.Str(description="Media type(s) that is/are acceptable for the response.",
-                                  validate=validate.OneOf(["image/tiff"]))
+                                  validate=validate.OneOf([media_types['output'], media_types['job_info'],
+                                                           media_types['job_result']]))
 
     return populate_parser(parser, default_conf)
 
@@ -252,4 +501,7 @@ def get_metadata():
                 _, value = line.split(": ", 1)
                 meta[par] = value
 
+    meta['Model cache'] = model_cache.stats()
+    meta['Batch jobs'] = job_queue.stats()
+
     return meta
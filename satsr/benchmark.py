@@ -0,0 +1,433 @@
+"""
+Benchmarks of the inference performed on synthetic data, to compare different inference settings on a given machine.
+
+Usage examples:
+
+    python -m satsr.benchmark parallel --size 2048 --workers 1 2 4 8
+    python -m satsr.benchmark autotune --satellite sentinel2 --res 20
+    python -m satsr.benchmark frozen --size 2048
+    python -m satsr.benchmark precision --res 20 --precisions float32 float16 int8
+    python -m satsr.benchmark memory --size 4096
+"""
+
+import argparse
+from datetime import datetime
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+from satsr import main_sat, config, paths
+from satsr.test_runfile import get_model_args
+from satsr.utils.model_utils import super_resolve, super_resolve_parallel, load_model, prepare_bands
+from satsr.utils import runtime_utils, data_utils
+from satsr.utils.frozen_model import load_frozen_model, precisions
+
+
+def synthetic_bands(size, max_res, seed=0):
+    """
+    Random bands for a square region of `size` pixels (at the minimal resolution).
+
+    Parameters
+    ----------
+    size : int
+    max_res : int
+        Maximal resolution of the bands to generate
+    seed : int
+
+    Returns
+    -------
+    A dict where the keys are int of the resolutions and values are numpy arrays (H, W, N)
+    """
+    rng = np.random.RandomState(seed)
+    mult = max(main_sat.upscaling_factor().values())
+    size = max(size // mult, 1) * mult
+    data_bands = {}
+    for res, band_list in main_sat.res_to_bands().items():
+        if res > max_res:
+            continue
+        side = size // main_sat.upscaling_factor()[res]
+        data_bands[res] = rng.uniform(main_sat.min_val(), main_sat.max_val() / 4.,
+                                      size=(side, side, len(band_list))).astype(np.float32)
+    return data_bands
+
+
+def get_sr_resolution(res=None):
+    """
+    Resolution to benchmark (by default the largest one of the satellite)
+    """
+    return res if res is not None else max(main_sat.res_to_bands().keys())
+
+
+def benchmark_parallel(workers_list, size=2048, res=None):
+    """
+    Time the super-resolution of a synthetic region for different numbers of worker processes.
+
+    Parameters
+    ----------
+    workers_list : list of ints
+    size : int
+        Side of the region (in pixels of the minimal resolution)
+    res : int
+        Resolution to super-resolve
+
+    Returns
+    -------
+    Dict with the time (in seconds) for each number of workers
+    """
+    res = get_sr_resolution(res)
+    patch_size, border = main_sat.patch_sizes()[res], main_sat.borders()[res]
+    model_args = get_model_args(res)
+    data_bands = prepare_bands(synthetic_bands(size, max_res=res))
+    warmup_bands = prepare_bands(synthetic_bands(2 * patch_size, max_res=res))
+
+    model = None
+    timings = {}
+    for num_workers in workers_list:
+        if num_workers > 1:
+            def run(bands):
+                return super_resolve_parallel(data_bands=bands, model_args=model_args, num_workers=num_workers,
+                                              patch_size=patch_size, border=border, prepared=True)
+        else:
+            model = model or load_model(**model_args)
+
+            def run(bands):
+                return super_resolve(data_bands=bands, model=model, patch_size=patch_size, border=border,
+                                     prepared=True)
+
+        run(warmup_bands)  # load the models in the workers and initialize the Tensorflow sessions
+        t0 = time.time()
+        run(data_bands)
+        timings[num_workers] = time.time() - t0
+
+    print('\nSuper-resolution of a {}x{} px synthetic region ({}m model)'.format(size, size, res))
+    print('{:<10}{:<12}{:<10}{:<10}'.format('workers', 'time (s)', 'speedup', 'efficiency'))
+    t_ref = timings[workers_list[0]] * workers_list[0]
+    for num_workers, t in timings.items():
+        speedup = t_ref / t
+        print('{:<10}{:<12.2f}{:<10.2f}{:<10.2f}'.format(num_workers, t, speedup, speedup / num_workers))
+
+    return timings
+
+
+def benchmark_frozen(size=2048, res=None, repeats=3):
+    """
+    Compare the Keras model with its exported inference graph (see `satsr.export`) on a synthetic region: maximal
+    difference between the outputs and best time of each one.
+
+    Parameters
+    ----------
+    size : int
+        Side of the region (in pixels of the minimal resolution)
+    res : int
+        Resolution to super-resolve
+    repeats : int
+
+    Returns
+    -------
+    Dict with the time (in seconds) of each model
+    """
+    res = get_sr_resolution(res)
+    patch_size, border = main_sat.patch_sizes()[res], main_sat.borders()[res]
+    model_args = get_model_args(res)
+    models = {'keras': load_model(input_shape=model_args['input_shape'], modelname=model_args['modelname']),
+              'frozen': load_frozen_model(model_args['modelname'])}
+    if models['frozen'] is None:
+        raise Exception('No inference graph found for {}. Export it first with `python -m satsr.export`.'.format(
+            model_args['modelname']))
+
+    data_bands = prepare_bands(synthetic_bands(size, max_res=res))
+    outputs, timings = {}, {}
+    for name, model in models.items():
+        timings[name] = np.inf
+        for _ in range(repeats + 1):  # the first run is a warm up
+            t0 = time.time()
+            outputs[name] = super_resolve(data_bands=data_bands, model=model, patch_size=patch_size, border=border,
+                                          prepared=True)
+            timings[name] = min(timings[name], time.time() - t0)
+
+    print('\nSuper-resolution of a {}x{} px synthetic region ({}m model)'.format(size, size, res))
+    print('{:<10}{:<12}{:<10}'.format('model', 'time (s)', 'speedup'))
+    for name, t in timings.items():
+        print('{:<10}{:<12.2f}{:<10.2f}'.format(name, t, timings['keras'] / t))
+    print('Max. absolute difference: {:.3g}'.format(np.amax(np.abs(outputs['keras'] - outputs['frozen']))))
+
+    return timings
+
+
+def get_val_sequence(res, batch_size=16):
+    """
+    Validation patches of a model. They are created from the tiles listed in the `val.txt` of the model if they are
+    not yet in the patches directory.
+    """
+    modelname = get_model_args(res)['modelname']
+    splits_dir = os.path.join(paths.get_models_dir(), modelname, 'dataset_files')
+    tiles = np.atleast_1d(data_utils.load_data_splits(splits_dir=splits_dir, split_name='val')).tolist()
+
+    missing = [t for t in tiles if not os.path.isdir(os.path.join(paths.get_patches_dir(), t))]
+    if missing:
+        data_utils.create_patches(tiles=missing, max_res=res,
+                                  tiles_dir=paths.get_tiles_dir(),
+                                  save_dir=paths.get_patches_dir(),
+                                  roi_x_y=config.conf_dict['training']['roi_x_y'],
+                                  num_patches=config.conf_dict['training']['num_patches'])
+    return data_utils.data_sequence(tiles=tiles, max_res=res, batch_size=batch_size, shuffle=False)
+
+
+def benchmark_precision(res=None, precisions_list=None, batch_size=16, max_batches=None):
+    """
+    Accuracy and throughput of the model in reduced precisions compared to float32, on the validation patches of the
+    model.
+
+    Parameters
+    ----------
+    res : int
+        Resolution of the model
+    precisions_list : list of strs
+    batch_size : int
+    max_batches : int
+        Maximal number of validation batches to use (all by default)
+
+    Returns
+    -------
+    Dict with the RMSE (in pixel values) and the throughput (in patches per second) of each precision
+    """
+    res = get_sr_resolution(res)
+    precisions_list = precisions_list or precisions
+    val_gen = get_val_sequence(res, batch_size=batch_size)
+    n_batches = len(val_gen) if max_batches is None else min(max_batches, len(val_gen))
+    scale = main_sat.max_val() - main_sat.min_val()  # patches are normalized
+
+    results = {}
+    for precision in precisions_list:
+        model = load_model(**get_model_args(res, precision=precision))
+        model.predict_on_batch(val_gen[0][0])  # warm up
+        sq_err, n_pixels, n_patches, t = 0., 0, 0, 0.
+        for i in range(n_batches):
+            X, y = val_gen[i]
+            t0 = time.time()
+            pred = model.predict_on_batch(X)
+            t += time.time() - t0
+            sq_err += np.sum((pred - y) ** 2, dtype=np.float64)
+            n_pixels += y.size
+            n_patches += len(y)
+        results[precision] = {'rmse': np.sqrt(sq_err / n_pixels) * scale, 'throughput': n_patches / t}
+
+    print('\nValidation of the {}m model on {} batches of {} patches'.format(res, n_batches, val_gen.batch_size))
+    print('{:<12}{:<12}{:<12}{:<16}{:<12}'.format('precision', 'RMSE', 'delta RMSE', 'patches/s', 'speedup'))
+    ref = results.get('float32', results[precisions_list[0]])
+    for precision, r in results.items():
+        print('{:<12}{:<12.4g}{:<12.4g}{:<16.2f}{:<12.2f}'.format(precision, r['rmse'], r['rmse'] - ref['rmse'],
+                                                                   r['throughput'], r['throughput'] / ref['throughput']))
+
+    return results
+
+
+def measure_memory(satellite, size, res):
+    """
+    Peak memory of the super-resolution of a synthetic region with a no-data margin (as `test()` does it, including
+    the masking of the fill values and the denormalization). Runs inside a fresh process so that the peak resident
+    memory is not the one of a previous run.
+    """
+    import resource
+    import tracemalloc
+    from satsr import test_runfile
+
+    config.conf_dict['general']['satellite'] = satellite
+    data_bands = {}
+    for tmp_res, bands in synthetic_bands(size, max_res=res).items():
+        bands = bands.astype(np.uint16)
+        bands[:, :bands.shape[1] // 8] = main_sat.fill_val()
+        data_bands[tmp_res] = bands
+
+    test_runfile.check_runtime_profile()
+    test_runfile.preload_model(res)  # the model is loaded beforehand so that its weights are not counted
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+    tracemalloc.start()  # numpy arrays are traced, the Tensorflow buffers are not
+    test_runfile.super_resolve_region(data_bands=data_bands, sr_resolutions=[res])
+    traced_peak = tracemalloc.get_traced_memory()[1] / 2**20
+    tracemalloc.stop()
+    return {'input (MB)': sum(bands.nbytes for bands in data_bands.values()) / 2**20,
+            'arrays peak (MB)': traced_peak,
+            'RSS before (MB)': rss_before,
+            'RSS peak (MB)': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10}
+
+
+def benchmark_memory(size=2048, res=None):
+    """
+    Peak memory of the super-resolution of a synthetic region. Run it on different versions of the code to compare
+    the memory footprint of the pre- and post-processing of the bands.
+
+    Parameters
+    ----------
+    size : int
+        Side of the region (in pixels of the minimal resolution)
+    res : int
+        Resolution to super-resolve
+
+    Returns
+    -------
+    Dict with the memory measurements (in MB)
+    """
+    res = get_sr_resolution(res)
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(processes=1) as pool:
+        results = pool.apply(measure_memory, (config.conf_dict['general']['satellite'], size, res))
+
+    print('\nPeak memory of the super-resolution of a {}x{} px synthetic region ({}m model)'.format(size, size, res))
+    for k, v in results.items():
+        print('{:<20}{:<10.1f}'.format(k, v))
+    return results
+
+
+def time_profile(profile, satellite, size, res):
+    """
+    Time the super-resolution of a synthetic region with a runtime profile. Runs inside a fresh process so that
+    the OpenMP/MKL variables of the profile are read when Tensorflow starts.
+    """
+    config.conf_dict['general']['satellite'] = satellite
+    runtime_utils.apply_runtime_profile(profile)
+    patch_size, border = main_sat.patch_sizes()[res], main_sat.borders()[res]
+    model = load_model(**dict(get_model_args(res), frozen=profile['frozen_models']))
+    data_bands = prepare_bands(synthetic_bands(size, max_res=res))
+    warmup_bands = prepare_bands(synthetic_bands(2 * patch_size, max_res=res))
+
+    super_resolve(data_bands=warmup_bands, model=model, patch_size=patch_size, border=border,
+                  batch_size=profile['batch_size'], prepared=True)
+    t0 = time.time()
+    super_resolve(data_bands=data_bands, model=model, patch_size=patch_size, border=border,
+                  batch_size=profile['batch_size'], prepared=True)
+    return time.time() - t0
+
+
+def run_trial(profile, satellite, size, res):
+    """
+    Run `time_profile()` in a new process with the environment variables of the profile.
+    """
+    old_environ = dict(os.environ)
+    runtime_utils.set_env_vars(profile)
+    try:
+        ctx = multiprocessing.get_context('spawn')
+        with ctx.Pool(processes=1) as pool:  # the child process copies the environment when it is spawned
+            return pool.apply(time_profile, (profile, satellite, size, res))
+    finally:
+        os.environ.clear()
+        os.environ.update(old_environ)
+
+
+def autotune(size=1024, res=None, threads_list=None, batch_sizes=None):
+    """
+    Find the fastest runtime profile of a model on this machine and save it in the model folder so that it can be
+    used with `runtime_profile: autotuned`.
+    The thread settings are tuned first (with the batch size given by the default memory budget) and then the batch
+    size is tuned with the best thread settings.
+
+    Parameters
+    ----------
+    size : int
+        Side of the synthetic region (in pixels of the minimal resolution)
+    res : int
+        Resolution of the model to tune
+    threads_list : list of ints
+        Candidate numbers of intra-op threads (by default all, half and a quarter of the cores)
+    batch_sizes : list of ints
+        Candidate batch sizes
+
+    Returns
+    -------
+    Dict with the fastest profile
+    """
+    res = get_sr_resolution(res)
+    satellite = config.conf_dict['general']['satellite']
+    modelname = get_model_args(res)['modelname']
+    cpu_count = multiprocessing.cpu_count()
+    if threads_list is None:
+        threads_list = sorted({cpu_count, max(1, cpu_count // 2), max(1, cpu_count // 4)}, reverse=True)
+    if batch_sizes is None:
+        batch_sizes = [4, 8, 16, 32, 64]
+
+    base = {k: config.conf_dict['runtime'][k] for k in runtime_utils.profile_keys.keys()}
+    base['batch_size'] = None
+    candidates = [dict(base, intra_op_threads=threads, inter_op_threads=inter_op, omp_num_threads=threads)
+                  for threads in threads_list for inter_op in (1, 2)]
+
+    results = []
+
+    def run_candidates(candidates):
+        for profile in candidates:
+            t = run_trial(profile, satellite=satellite, size=size, res=res)
+            results.append((t, profile))
+            print('intra_op={intra_op_threads} inter_op={inter_op_threads} batch_size={batch_size}'.format(**profile),
+                  '--> {:.2f} s'.format(t))
+        return min(results, key=lambda r: r[0])
+
+    print('Tuning threads ...')
+    t_best, best = run_candidates(candidates)
+    print('Tuning batch size ...')
+    run_candidates([dict(best, batch_size=bs) for bs in batch_sizes])
+
+    # Keep the fastest profile with an explicit batch size
+    t_best, best = min([r for r in results if r[1]['batch_size'] is not None], key=lambda r: r[0])
+
+    profile = dict(best, time=t_best, size=size, cpu_count=cpu_count,
+                   date=datetime.now().strftime('%Y-%m-%d_%H%M%S'))
+    runtime_utils.save_profile(profile, modelname)
+    print('\nFastest profile for {} ({:.2f} s for a {}x{} px region) saved to {}'.format(
+        modelname, t_best, size, size, runtime_utils.get_profile_path(modelname)))
+    return profile
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of the super-resolution inference')
+    parser.add_argument('--satellite', type=str, default=None,
+                        choices=config.CONF['general']['satellite']['choices'])
+    subparsers = parser.add_subparsers(dest='command')
+
+    p = subparsers.add_parser('parallel', help='Scaling of the inference with the number of worker processes')
+    p.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    p.add_argument('--size', type=int, default=2048)
+    p.add_argument('--res', type=int, default=None)
+
+    p = subparsers.add_parser('autotune', help='Find and save the fastest runtime profile of a model')
+    p.add_argument('--size', type=int, default=1024)
+    p.add_argument('--res', type=int, default=None)
+    p.add_argument('--threads', type=int, nargs='+', default=None)
+    p.add_argument('--batch-sizes', type=int, nargs='+', default=None)
+
+    p = subparsers.add_parser('frozen', help='Compare a Keras model with its exported inference graph')
+    p.add_argument('--size', type=int, default=2048)
+    p.add_argument('--res', type=int, default=None)
+    p.add_argument('--repeats', type=int, default=3)
+
+    p = subparsers.add_parser('precision', help='Accuracy and throughput of the reduced precision models')
+    p.add_argument('--res', type=int, default=None)
+    p.add_argument('--precisions', type=str, nargs='+', default=precisions, choices=precisions)
+    p.add_argument('--batch-size', type=int, default=16)
+    p.add_argument('--max-batches', type=int, default=None)
+
+    p = subparsers.add_parser('memory', help='Peak memory of the super-resolution of a region')
+    p.add_argument('--size', type=int, default=2048)
+    p.add_argument('--res', type=int, default=None)
+
+    args = parser.parse_args()
+    if args.satellite:
+        config.conf_dict['general']['satellite'] = args.satellite
+
+    if args.command == 'parallel':
+        benchmark_parallel(workers_list=args.workers, size=args.size, res=args.res)
+    elif args.command == 'autotune':
+        autotune(size=args.size, res=args.res, threads_list=args.threads, batch_sizes=args.batch_sizes)
+    elif args.command == 'frozen':
+        benchmark_frozen(size=args.size, res=args.res, repeats=args.repeats)
+    elif args.command == 'precision':
+        benchmark_precision(res=args.res, precisions_list=args.precisions, batch_size=args.batch_size,
+                            max_batches=args.max_batches)
+    elif args.command == 'memory':
+        benchmark_memory(size=args.size, res=args.res)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
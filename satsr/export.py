@@ -0,0 +1,56 @@
+"""
+Export the models of a satellite to optimized inference graphs (see `satsr.utils.frozen_model`). The exported graphs
+are loaded instead of the Keras weights when `frozen_models` is enabled.
+
+Usage example:
+
+    python -m satsr.export --satellite sentinel2 --precisions float32 float16 int8
+"""
+
+import argparse
+
+from keras import backend as K
+
+from satsr import main_sat, config
+from satsr.test_runfile import get_model_args
+from satsr.utils.model_utils import load_model
+from satsr.utils.frozen_model import export_model, precisions
+
+
+def export(resolutions=None, precisions_list=('float32',)):
+    """
+    Parameters
+    ----------
+    resolutions : list of ints
+        Resolutions of the models to export. If None all the models of the satellite are exported.
+    precisions_list : list of strs
+        Precisions in which to export each model
+    """
+    sat_resolutions = sorted(main_sat.res_to_bands().keys())
+    if resolutions is None:
+        resolutions = sat_resolutions[1:]
+
+    for res in resolutions:
+        K.clear_session()
+        model_args = get_model_args(res)
+        model = load_model(input_shape=model_args['input_shape'], modelname=model_args['modelname'], frozen=False)
+        for precision in precisions_list:
+            export_model(model, input_shape=model_args['input_shape'], modelname=model_args['modelname'],
+                         precision=precision)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export the models to optimized inference graphs')
+    parser.add_argument('--satellite', type=str, default=None,
+                        choices=config.CONF['general']['satellite']['choices'])
+    parser.add_argument('--res', type=int, nargs='+', default=None)
+    parser.add_argument('--precisions', type=str, nargs='+', default=['float32'], choices=precisions)
+
+    args = parser.parse_args()
+    if args.satellite:
+        config.conf_dict['general']['satellite'] = args.satellite
+    export(resolutions=args.res, precisions_list=args.precisions)
+
+
+if __name__ == '__main__':
+    main()
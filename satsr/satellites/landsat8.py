@@ -51,7 +51,7 @@ min_val = 1
 fill_val = 0
 
 
-def read_bands(tile_path, roi_x_y=None, roi_lon_lat=None, max_res=30):
+def read_bands(tile_path, roi_x_y=None, roi_lon_lat=None, max_res=30, load_data=True, downsample=1):
     """
     Parameters
     ----------
@@ -59,6 +59,11 @@ def read_bands(tile_path, roi_x_y=None, roi_lon_lat=None, max_res=30):
     roi_x_y : list of ints
     roi_lon_lat : list of floats
     max_res : int
+    load_data : bool
+        If False, only the region of interest is computed and no band is read (data_bands is returned as None).
+    downsample : int
+        If larger than 1, the bands are read at a lower resolution (decimated by this factor), using the overviews of
+        the files when available. This allows to have a cheap preview of the region of interest.
 
     Returns
     -------
@@ -128,6 +133,18 @@ def read_bands(tile_path, roi_x_y=None, roi_lon_lat=None, max_res=30):
     print("Selected pixel region: xmin=%d, ymin=%d, xmax=%d, ymax=%d:" % (xmin, ymin, xmax, ymax))
     print("Image size: width=%d x height=%d" % (xmax - xmin + 1, ymax - ymin + 1))
 
+    # Get coordinates
+    coord = {'xmin': xmin,
+             'ymin': ymin,
+             'xmax': xmax,
+             'ymax': ymax,
+             'geotransform': ds_bands[15][0].GetGeoTransform(),
+             'geoprojection': ds_bands[15][0].GetProjection(),
+             'band_sources': [(tmp_ds.GetDescription(), 1) for tmp_ds in ds_bands[15]]}
+
+    if not load_data:
+        return None, coord
+
     # Reading dataset bands into an array
     data_bands = {res: None for res in resolutions}
     for res in resolutions:
@@ -137,17 +154,12 @@ def read_bands(tile_path, roi_x_y=None, roi_lon_lat=None, max_res=30):
         for tmp_ds in ds_bands[res]:
             tmp_arr = tmp_ds.ReadAsArray(xoff=xmin // uf, yoff=ymin // uf,
                                          xsize=(xmax - xmin + 1) // uf, ysize=(ymax - ymin + 1) // uf,
-                                         buf_xsize=(xmax - xmin + 1) // uf, buf_ysize=(ymax - ymin + 1) // uf)
+                                         buf_xsize=max((xmax - xmin + 1) // uf // downsample, 1),
+                                         buf_ysize=max((ymax - ymin + 1) // uf // downsample, 1))
             data_bands[res].append(tmp_arr)
         data_bands[res] = np.array(data_bands[res])
         data_bands[res] = np.moveaxis(data_bands[res], 0, -1)  # move to channels last
 
-    # Get coordinates
-    coord = {'xmin': xmin,
-             'ymin': ymin,
-             'geotransform': ds_bands[15][0].GetGeoTransform(),
-             'geoprojection': ds_bands[15][0].GetProjection()}
-
     return data_bands, coord
 
 
@@ -71,7 +71,7 @@ min_val = -100
 fill_val = -28672
 
 
-def read_bands(tile_path, roi_x_y=None, roi_lon_lat=None, max_res=1000):
+def read_bands(tile_path, roi_x_y=None, roi_lon_lat=None, max_res=1000, load_data=True, downsample=1):
 
     print('Loading {}'.format(tile_path))
 
@@ -132,20 +132,6 @@ def read_bands(tile_path, roi_x_y=None, roi_lon_lat=None, max_res=1000):
     print("Selected pixel region: xmin=%d, ymin=%d, xmax=%d, ymax=%d:" % (xmin, ymin, xmax, ymax))
     print("Image size: width=%d x height=%d" % (xmax - xmin + 1, ymax - ymin + 1))
 
-    # Reading dataset bands into an array
-    data_bands = {res: None for res in resolutions}
-    for res in resolutions:
-        print("Loading arrays from: {}m".format(res))
-        data_bands[res] = []
-        uf = upscaling_factor[res]
-        for tmp_ds in ds_bands[res]:
-            tmp_arr = tmp_ds.ReadAsArray(xoff=xmin // uf, yoff=ymin // uf,
-                                         xsize=(xmax - xmin + 1) // uf, ysize=(ymax - ymin + 1) // uf,
-                                         buf_xsize=(xmax - xmin + 1) // uf, buf_ysize=(ymax - ymin + 1) // uf)
-            data_bands[res].append(tmp_arr)
-        data_bands[res] = np.array(data_bands[res])
-        data_bands[res] = np.moveaxis(data_bands[res], 0, -1)  # move to channels last
-
     ####################
     # FIXME: Try to find what is the projection and the geotransform (degrees not meters?) for MODIS
     #  (this one has been hardcoded from Sentinel 2)
@@ -159,8 +145,11 @@ def read_bands(tile_path, roi_x_y=None, roi_lon_lat=None, max_res=1000):
     # Get coordinates
     coord = {'xmin': xmin,
              'ymin': ymin,
+             'xmax': xmax,
+             'ymax': ymax,
              'geotransform': (0.0, 250.0, 0.0, 0.0, 0.0, -250.0),
-             'geoprojection': 'PROJCS["WGS 84 / UTM zone 30N",GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,298.257223563,AUTHORITY["EPSG","7030"]],AUTHORITY["EPSG","6326"]],PRIMEM["Greenwich",0,AUTHORITY["EPSG","8901"]],UNIT["degree",0.0174532925199433,AUTHORITY["EPSG","9122"]],AUTHORITY["EPSG","4326"]],PROJECTION["Transverse_Mercator"],PARAMETER["latitude_of_origin",0],PARAMETER["central_meridian",-3],PARAMETER["scale_factor",0.9996],PARAMETER["false_easting",500000],PARAMETER["false_northing",0],UNIT["metre",1,AUTHORITY["EPSG","9001"]],AXIS["Easting",EAST],AXIS["Northing",NORTH],AUTHORITY["EPSG","32630"]]'}
+             'geoprojection': 'PROJCS["WGS 84 / UTM zone 30N",GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,298.257223563,AUTHORITY["EPSG","7030"]],AUTHORITY["EPSG","6326"]],PRIMEM["Greenwich",0,AUTHORITY["EPSG","8901"]],UNIT["degree",0.0174532925199433,AUTHORITY["EPSG","9122"]],AUTHORITY["EPSG","4326"]],PROJECTION["Transverse_Mercator"],PARAMETER["latitude_of_origin",0],PARAMETER["central_meridian",-3],PARAMETER["scale_factor",0.9996],PARAMETER["false_easting",500000],PARAMETER["false_northing",0],UNIT["metre",1,AUTHORITY["EPSG","9001"]],AXIS["Easting",EAST],AXIS["Northing",NORTH],AUTHORITY["EPSG","32630"]]',
+             'band_sources': [(tmp_ds.GetDescription(), 1) for tmp_ds in ds_bands[250]]}
 
     # # Get coordinates
     # coord = {'xmin': xmin,
@@ -169,6 +158,24 @@ def read_bands(tile_path, roi_x_y=None, roi_lon_lat=None, max_res=1000):
     #          'geoprojection': ds_bands[250][0].GetProjection()}
     ####################
 
+    if not load_data:
+        return None, coord
+
+    # Reading dataset bands into an array
+    data_bands = {res: None for res in resolutions}
+    for res in resolutions:
+        print("Loading arrays from: {}m".format(res))
+        data_bands[res] = []
+        uf = upscaling_factor[res]
+        for tmp_ds in ds_bands[res]:
+            tmp_arr = tmp_ds.ReadAsArray(xoff=xmin // uf, yoff=ymin // uf,
+                                         xsize=(xmax - xmin + 1) // uf, ysize=(ymax - ymin + 1) // uf,
+                                         buf_xsize=max((xmax - xmin + 1) // uf // downsample, 1),
+                                         buf_ysize=max((ymax - ymin + 1) // uf // downsample, 1))
+            data_bands[res].append(tmp_arr)
+        data_bands[res] = np.array(data_bands[res])
+        data_bands[res] = np.moveaxis(data_bands[res], 0, -1)  # move to channels last
+
     return data_bands, coord
 
 
@@ -54,7 +54,7 @@ min_val = 1
 fill_val = 0
 
 
-def read_bands(tile_path, roi_x_y=None, roi_lon_lat=None, max_res=60, select_UTM=''):
+def read_bands(tile_path, roi_x_y=None, roi_lon_lat=None, max_res=60, select_UTM='', load_data=True, downsample=1):
     """
 
     Parameters
@@ -64,6 +64,11 @@ def read_bands(tile_path, roi_x_y=None, roi_lon_lat=None, max_res=60, select_UTM
     roi_lon_lat : list of floats
     max_res : int
     select_UTM : str
+    load_data : bool
+        If False, only the region of interest is computed and no band is read (data_bands is returned as None).
+    downsample : int
+        If larger than 1, the bands are read at a lower resolution (decimated by this factor), using the overviews of
+        the files when available. This allows to have a cheap preview of the region of interest.
 
     Returns
     -------
@@ -204,6 +209,17 @@ def read_bands(tile_path, roi_x_y=None, roi_lon_lat=None, max_res=60, select_UTM
                                                         'Expected band list: {} \n' \
                                                         'Actual band list: {}'.format(res, res_to_bands[res], validated_bands[res])
 
+    coord = {'xmin': xmin,
+             'ymin': ymin,
+             'xmax': xmax,
+             'ymax': ymax,
+             'geotransform': ds_bands[10].GetGeoTransform(),
+             'geoprojection': ds_bands[10].GetProjection(),
+             'band_sources': [(selected_dataset[10][0], b + 1) for b in validated_indices[10]]}
+
+    if not load_data:
+        return None, coord
+
     # Reading dataset bands into an array
     data_bands = {res: None for res in resolutions}
     upscaling_factor = {10: 1, 20: 2, 60: 6}
@@ -213,15 +229,11 @@ def read_bands(tile_path, roi_x_y=None, roi_lon_lat=None, max_res=60, select_UTM
         uf = upscaling_factor[res]
         data_bands[res] = ds_bands[res].ReadAsArray(xoff=xmin // uf, yoff=ymin // uf,
                                                     xsize=(xmax - xmin + 1) // uf, ysize=(ymax - ymin + 1) // uf,
-                                                    buf_xsize=(xmax - xmin + 1) // uf, buf_ysize=(ymax - ymin + 1) // uf)
+                                                    buf_xsize=max((xmax - xmin + 1) // uf // downsample, 1),
+                                                    buf_ysize=max((ymax - ymin + 1) // uf // downsample, 1))
         data_bands[res] = np.moveaxis(data_bands[res], source=0, destination=-1)  # move to channels last
         data_bands[res] = data_bands[res][:, :, validated_indices[res]]
 
-    coord = {'xmin': xmin,
-             'ymin': ymin,
-             'geotransform': ds_bands[10].GetGeoTransform(),
-             'geoprojection': ds_bands[10].GetProjection()}
-
     return data_bands, coord
 
 
@@ -8,153 +8,673 @@ Github: ignacioheredia
 """
 
 import os
+from contextlib import contextmanager
+import shutil
+from functools import partial
+from math import ceil
+import threading
 
 import numpy as np
-from keras import backend as K
 
 from satsr import paths, main_sat, config
-from satsr.utils.model_utils import super_resolve, load_model
-from satsr.utils import gdal_utils
+from satsr.utils.model_utils import super_resolve, super_resolve_parallel, load_model, prepare_bands, close_pools
+from satsr.utils import gdal_utils, runtime_utils, tile_cache
+from satsr.utils.chunk_store import ChunkStore
+from satsr.utils.model_cache import ModelCache
+from satsr.utils.pipeline import prefetch_map, AsyncWriter
 
 
-# Load the models for different resolutions in a dict
-models, models_sat = None, None
+# Models kept in memory between predictions (for any satellite) and process-wide runtime settings applied
+model_cache = ModelCache(memory_budget=config.conf_dict['runtime']['model_cache_memory'])
+process_profile = None
 
 
-def load_models():
-    global models, models_sat
-    K.clear_session()
-    models_sat = config.conf_dict['general']['satellite']
-    models = {}
+def get_model_args(res, precision='float32'):
+    """
+    Arguments to load the model of a given resolution with `load_model()`
+    """
     default_shapes = main_sat.input_shapes()
     resolutions = main_sat.res_to_bands().keys()
-    min_res = min(resolutions)
+    input_shape = {str(tmp_res): default_shapes[str(tmp_res)] for tmp_res in resolutions if tmp_res <= res}
+    modelname = '{}_model_{}m'.format(config.conf_dict['general']['satellite'], res)
+    return {'input_shape': input_shape, 'modelname': modelname, 'frozen': get_model_profile(res)['frozen_models'],
+            'precision': precision}
+
+
+def get_model_profile(res):
+    """
+    Runtime settings of the model of a given resolution for the current satellite (see
+    `runtime_utils.get_model_profile()`)
+    """
+    return runtime_utils.get_model_profile(runtime_utils.get_runtime_profile(), res)
+
+
+def check_runtime_profile():
+    """
+    Apply the process-wide settings of the runtime profile of the current configuration. If they have changed, the
+    worker processes are closed so that they start again with them. The resident models are kept, as the settings of
+    each model are part of its key in the cache (see `use_model()`).
+    """
+    global process_profile
+    profile = runtime_utils.get_runtime_profile()
+    tmp_profile = {k: profile[k] for k in runtime_utils.process_keys}
+    if tmp_profile != process_profile:
+        close_pools()
+        runtime_utils.apply_runtime_profile(profile)
+        process_profile = tmp_profile
+    model_cache.memory_budget = config.conf_dict['runtime']['model_cache_memory']
+
+
+@contextmanager
+def use_model(res, precision='float32'):
+    """
+    Context manager with the model of a given resolution for the current satellite. It is loaded if it is not already
+    in memory, and it is not released from memory while it is used.
+    """
+    model_args = get_model_args(res, precision=precision)
+    model_profile = get_model_profile(res)
+    weights_path = os.path.join(paths.get_models_dir(), model_args['modelname'], 'ckpts', 'final_model.h5')
+    key = (config.conf_dict['general']['satellite'], res, weights_path, precision, model_args['frozen'],
+           model_profile['intra_op_threads'], model_profile['inter_op_threads'], model_profile['xla_jit'])
+    with model_cache.use(key, loader=partial(load_model, **model_args),
+                         tf_config=runtime_utils.get_tf_config(model_profile)) as model:
+        yield model
+
+
+def preload_model(res):
+    with use_model(res):
+        pass
+
+
+def get_sr_resolutions(max_res=None):
+    """
+    Resolutions to super-resolve (and therefore models needed) for a given `max_res`. If None, all the resolutions are
+    super-resolved.
+    """
+    sat_resolutions = list(main_sat.res_to_bands().keys())
+    min_res = min(sat_resolutions)
+    if max_res is None:
+        return [res for res in sat_resolutions if res != min_res]
+
+    assert max_res in sat_resolutions, "The selected resolution is not an available choice"
+    assert max_res != min_res, "The super-resolution must be larger than the smaller resolution"
+    return [max_res]
+
+
+def load_models(max_res=None, background=False):
+    """
+    Load in memory the models of the current satellite needed to super-resolve up to `max_res`. Models that are not
+    preloaded are loaded the first time a prediction needs them.
+
+    Parameters
+    ----------
+    max_res : int
+    background : bool
+        If True, the models are loaded in a background thread. Predictions that need one of them wait until it is ready.
+    """
+    check_runtime_profile()
+    resolutions = get_sr_resolutions(max_res)
+    if background:
+        thread = threading.Thread(target=lambda: [preload_model(res) for res in resolutions], daemon=True)
+        thread.start()
+        return thread
     for res in resolutions:
-        if res == min_res:  # no need to build a model for the minimum resolution
+        preload_model(res)
+
+
+def get_windows(start, stop, size, min_size=0):
+    """
+    Split the pixel range [start, stop) into consecutive windows of `size` pixels. If the last window is smaller than
+    `min_size` it is merged with the previous one.
+
+    Returns
+    -------
+    List of (start, stop) tuples
+    """
+    starts = list(range(start, stop, size))
+    if len(starts) > 1 and (stop - starts[-1]) < min_size:
+        del starts[-1]
+    stops = starts[1:] + [stop]
+    return list(zip(starts, stops))
+
+
+def get_valid_roi(tile_path, max_res, roi_x_y=None, roi_lon_lat=None, downsample=16):
+    """
+    Shrink a region of interest to the bounding box of its valid pixels (ie. pixels that are not fill_val in every
+    band). The bounding box is computed from a low resolution read of the bands (see `downsample` in `read_bands()`),
+    so that the no-data margins of the tile are neither read at full resolution nor super-resolved.
+
+    Returns
+    -------
+    roi_x_y : list of ints
+        Trimmed region of interest, in pixels at the minimal resolution
+    roi_lon_lat : list of floats
+        None if the region has been trimmed
+    """
+    read_fn = main_sat.read_bands()
+    preview, coord = read_fn(tile_path=tile_path, max_res=max_res, roi_x_y=roi_x_y, roi_lon_lat=roi_lon_lat,
+                             downsample=downsample)
+    y0, x0, y1, x1 = coord['ymin'], coord['xmin'], coord['ymax'] + 1, coord['xmax'] + 1
+
+    # Bounding box of the valid pixels of each resolution. As decimated reads can miss the valid pixels at the edges,
+    # the boxes are enlarged by one pixel of the preview on each side.
+    boxes = []
+    for bands in preview.values():
+        valid = np.any(bands != main_sat.fill_val(), axis=2)
+        if not valid.any():
             continue
-        input_shape = {str(tmp_res): default_shapes[str(tmp_res)] for tmp_res in resolutions if tmp_res <= res}
-        models[res] = load_model(input_shape=input_shape, modelname='{}_model_{}m'.format(models_sat, res))
+        rows, cols = np.flatnonzero(valid.any(axis=1)), np.flatnonzero(valid.any(axis=0))
+        step_y, step_x = (y1 - y0) / valid.shape[0], (x1 - x0) / valid.shape[1]
+        boxes.append([y0 + int((rows[0] - 1) * step_y), x0 + int((cols[0] - 1) * step_x),
+                      y0 + int(ceil((rows[-1] + 2) * step_y)), x0 + int(ceil((cols[-1] + 2) * step_x))])
+    if not boxes:
+        print('No valid pixels found in the region of interest. It will not be trimmed.')
+        return roi_x_y, roi_lon_lat
+    boxes = np.array(boxes)
+
+    # Align the box with the pixels of the coarsest resolution and keep it larger than a patch
+    mult = main_sat.upscaling_factor()[max_res]
+    min_size = max(main_sat.patch_sizes()[res] for res in get_sr_resolutions(max_res))
+    box = []
+    for start, stop, lo, hi in [(boxes[:, 0].min(), boxes[:, 2].max(), y0, y1),
+                                (boxes[:, 1].min(), boxes[:, 3].max(), x0, x1)]:
+        start, stop = max(start // mult * mult, lo), min(-(-stop // mult) * mult, hi)
+        size = min(-(-min_size // mult) * mult, hi - lo)
+        if stop - start < size:
+            start = min(max(start - (size - (stop - start)) // 2 // mult * mult, lo), hi - size)
+            stop = start + size
+        box.append((int(start), int(stop)))
+    (ty0, ty1), (tx0, tx1) = box
+    trimmed_roi = [tx0, ty0, tx1 - 1, ty1 - 1]
+
+    # Check the same georeferencing is kept (eg. the same UTM zone for Sentinel-2)
+    _, trimmed_coord = read_fn(tile_path=tile_path, max_res=max_res, roi_x_y=trimmed_roi, load_data=False)
+    if list(trimmed_coord['geotransform']) != list(coord['geotransform']):
+        return roi_x_y, roi_lon_lat
+
+    print('Trimmed the region of interest from {}x{} to {}x{} pixels'.format(x1 - x0, y1 - y0, tx1 - tx0, ty1 - ty0))
+    return trimmed_roi, None
+
+
+def super_resolve_region(data_bands, sr_resolutions, batch_size=None, memory_budget=1024, prefetch_workers=1,
+                         num_processes=1, precision='float32', output_fn=None):
+    """
+    Super-resolve a region of a tile loaded in memory.
+
+    Parameters
+    ----------
+    data_bands : dict
+        Bands as returned by `read_bands()`.
+    sr_resolutions : list of ints
+        Resolutions to super-resolve
+    batch_size : int
+    memory_budget : int
+    prefetch_workers : int
+        See `super_resolve()`
+    num_processes : int
+        If larger than 1, the patches are split among several processes (see `super_resolve_parallel()`)
+    precision : str
+        Precision of the models (see `load_model()`)
+    output_fn : callable
+        Function called with `(res, bands)` as soon as the bands of each resolution are super-resolved. If given, the
+        bands are not kept afterwards, so that only one resolution is held in memory at a time.
+
+    Returns
+    -------
+    A dict where the keys are the super-resolved resolutions and values are numpy arrays (H, W, N) at the minimal
+    resolution (None if the bands were passed to `output_fn`).
+    """
+    min_res = min(data_bands.keys())
 
+    # Compute mask of fill_values and set fill_values--> min_values for processing
+    mask = {}
+    for res, bands in data_bands.items():
+        mask[res] = (bands == main_sat.fill_val())
+        bands[mask[res]] = main_sat.min_val()
 
-def test(tile_path, max_res=None, output_path=None, roi_x_y=None, roi_lon_lat=None, copy_original_bands=True,
-         output_file_format='GTiff'):
+    # Normalize and upsample each input resolution once, as they are shared by the models of all resolutions
+    prepared_bands = prepare_bands({res: bands for res, bands in data_bands.items() if res <= max(sr_resolutions)})
 
-    # Check resolutions
-    sat_resolutions = list(main_sat.res_to_bands().keys())
-    min_res = min(sat_resolutions)
-    if max_res is None:  # we super-resolve for all possible resolutions
-        max_res = max(sat_resolutions)
-        sr_resolutions = [res for res in sat_resolutions if res != min_res]
+    # Perform super-resolution
+    mean_mask = np.all(mask[min_res], axis=2)  # most restrictive mask at the min_resolution (in case masks of bands at minimum are different).
+    sr_bands = {res: None for res in sr_resolutions}
+    for res in sr_bands.keys():
+        print('Super resolving {}m ...'.format(res))
+        tmp_bands = {tmp_res: bands for tmp_res, bands in prepared_bands.items() if tmp_res <= res}
+        min_side = min(data_bands[res].shape[:2])
+        tmp_patchsize = min(main_sat.patch_sizes()[res], min_side)
+        tmp_batch_size = batch_size or get_model_profile(res)['batch_size']  # fall back to the autotuned batch size
+
+        # Patches whose output is entirely replaced by fill_values below are not predicted
+        nodata = mask[res].all(axis=2) if (res % min_res) == 0 else None
+        if num_processes > 1:
+            sr_bands[res] = super_resolve_parallel(data_bands=tmp_bands, num_workers=num_processes,
+                                                   model_args=get_model_args(res, precision=precision),
+                                                   patch_size=tmp_patchsize, border=main_sat.borders()[res],
+                                                   batch_size=tmp_batch_size, memory_budget=memory_budget,
+                                                   prepared=True, nodata=nodata)
+        else:
+            with use_model(res, precision=precision) as model:
+                sr_bands[res] = super_resolve(data_bands=tmp_bands, model=model,
+                                              patch_size=tmp_patchsize, border=main_sat.borders()[res],
+                                              batch_size=tmp_batch_size, memory_budget=memory_budget, prepared=True,
+                                              prefetch_workers=prefetch_workers, nodata=nodata)
+
+        # Replace back with fill_values the super-resolved bands. The masks are broadcast to the minimal resolution
+        # instead of being upscaled.
+        bands = sr_bands[res]
+        if (res % min_res) == 0:  # resolutions are multiples of one another
+            scale = int(res / min_res)
+            h, w, c = mask[res].shape
+            blocks = bands.view()
+            blocks.shape = (h, scale, w, scale, c)  # raises instead of copying if it cannot be a view
+            np.copyto(blocks, main_sat.fill_val(), where=mask[res][:, None, :, None, :])
+        else:
+            np.copyto(bands, main_sat.fill_val(), where=mean_mask[:, :, None])
+
+        if output_fn is not None:
+            output_fn(res, bands)
+            sr_bands[res] = bands = None
+    del prepared_bands
+
+    # Replace back with fill_values the original bands
+    for res, bands in data_bands.items():
+        data_bands[res][mask[res]] = main_sat.fill_val()
+
+    # # Keep only the values that where different from zero in the original array (filter with mask)
+    # mask = (data_bands[min_res][:, :, 0] != 0)
+    # sr_bands = {res: bands * mask[:, :, None] for res, bands in sr_bands.items()}
+
+    return sr_bands
+
+
+def create_output(output_path, output_file_format, xsize, ysize, names, descriptions, geotransform, geoprojection,
+                  native_dtype, output_dtype='float64', output_compression='DEFLATE', output_tiled=True,
+                  output_threads=0):
+    """
+    Create the output file: a GDAL dataset or a `ChunkStore` for the 'chunked' format.
+
+    Parameters
+    ----------
+    output_path : str
+    output_file_format : str
+    xsize, ysize : int
+    names : list of strs
+        Short names of the bands
+    descriptions : list of strs
+    geotransform
+    geoprojection
+    native_dtype : numpy dtype
+        Data type of the bands read from the tile
+    output_dtype : str
+    output_compression : str
+    output_tiled : bool
+    output_threads : int
+        See `test()`
+    """
+    dtype, scale, offset = gdal_utils.get_output_dtype(output_dtype,
+                                                       native_dtype=native_dtype,
+                                                       min_val=main_sat.min_val(),
+                                                       max_val=main_sat.max_val(),
+                                                       fill_val=main_sat.fill_val())
+    if output_file_format == 'chunked':
+        return ChunkStore(output_path, mode='w', xsize=xsize, ysize=ysize, names=names, descriptions=descriptions,
+                          geotransform=geotransform, geoprojection=geoprojection, dtype=dtype, scale=scale,
+                          offset=offset, num_threads=output_threads)
+    return gdal_utils.create_gdal(output_path=output_path,
+                                  xsize=xsize,
+                                  ysize=ysize,
+                                  descriptions=descriptions,
+                                  geotransform=geotransform,
+                                  geoprojection=geoprojection,
+                                  file_format=output_file_format,
+                                  dtype=dtype,
+                                  scale=scale,
+                                  offset=offset,
+                                  compression=output_compression,
+                                  tiled=output_tiled,
+                                  num_threads=output_threads,
+                                  nodata=main_sat.fill_val())
+
+
+def write_output(output, bands, band_offset=0, xoff=0, yoff=0, overviews=False):
+    """
+    Write bands into a window of the output (see `gdal_utils.write_gdal()`)
+    """
+    if isinstance(output, ChunkStore):
+        output.write(bands, band_offset=band_offset, xoff=xoff, yoff=yoff)
     else:
-        assert max_res in sat_resolutions, "The selected resolution is not an available choice"
-        assert max_res != min_res, "The super-resolution must be larger than the smaller resolution"
-        sr_resolutions = [max_res]
+        gdal_utils.write_gdal(output, bands=bands, band_offset=band_offset, xoff=xoff, yoff=yoff, overviews=overviews)
 
-    # Load models if needed
-    if (models is None) or (models_sat != config.conf_dict['general']['satellite']):
-        load_models()
 
-    # Process output file name and format
-    if output_path is None:
-        print("Error: you must provide the name of an output file. I will set it identical to the input...")
-        output_name = os.path.split(tile_path)[1] + '.tif'
-        output_path = os.path.join(paths.get_test_dir(), 'outputs', output_name)
+def close_output(output, output_path, output_file_format, output_compression=None, output_threads=0,
+                 overviews_written=False):
+    """
+    Finish writing the output (see `gdal_utils.close_gdal()`)
+    """
+    if isinstance(output, ChunkStore):
+        output.close()
+    else:
+        gdal_utils.close_gdal(output, output_path=output_path, file_format=output_file_format,
+                              compression=output_compression, num_threads=output_threads,
+                              overviews_written=overviews_written)
+
 
+def get_output_path(output_path, output_file_format):
+    """
+    Format and path of the output actually written by `test()` for the requested ones.
+
+    Returns
+    -------
+    output_file_format : str
+        The requested format, or 'chunked' if GDAL can not create files in that format
+    output_path : str
+    """
     if output_file_format == 'ENVI' and output_path[-4:].lower() == '.hdr':
         output_path = output_path[:-4] + '.bin'  # ENVI file name should be the .bin, not the .hdr
 
-    if not gdal_utils.check_gdal_format(output_file_format):
+    if output_file_format != 'chunked' and not gdal_utils.check_gdal_format(output_file_format):
         print("GDAL doesn't support creating %s files" % output_file_format)
         gdal_utils.print_gdal_file_formats()
         print("\n")
-        print("Writing to npz as a fallback")
-        output_file_format = "npz"
+        print("Writing to a chunked array store as a fallback")
+        output_file_format = "chunked"
+
+    if output_file_format == 'chunked':
+        output_path = os.path.splitext(output_path)[0] + '.chunks'
+
+    return output_file_format, output_path
+
+
+def get_vrt_paths(output_path):
+    """
+    Paths of the VRT and of the file with the super-resolved bands when the original bands are referenced from a VRT
+    """
+    root, ext = os.path.splitext(output_path)
+    if ext.lower() in ['', '.vrt']:
+        ext = '.tif'
+    return root + '.vrt', root + '_sr' + ext
+
+
+def create_stacked_vrt(vrt_path, sr_path, coord, sr_descriptions):
+    """
+    Create a VRT with the original bands of minimal resolution, referenced from the tile, followed by the super-resolved
+    bands, referenced from their output file. The bands have the same order and descriptions as when the original bands
+    are copied into the output file.
+
+    Parameters
+    ----------
+    vrt_path : str
+    sr_path : str
+        Output file with the super-resolved bands
+    coord : dict
+        Coordinates of the region of interest returned by the `read_bands()` of the satellite
+    sr_descriptions : list of strs
+        Descriptions of the super-resolved bands
+    """
+    min_res = min(main_sat.res_to_bands().keys())
+    geot = list(coord['geotransform'])
+    geot[0] += coord['xmin'] * min_res
+    geot[3] -= coord['ymin'] * min_res
 
-    # Load bands
-    data_bands, coord = main_sat.read_bands()(tile_path=tile_path, max_res=max_res, roi_x_y=roi_x_y,
-                                              roi_lon_lat=roi_lon_lat)
+    sources = [(name, band_number, coord['xmin'], coord['ymin']) for name, band_number in coord['band_sources']]
+    sources += [(sr_path, i + 1, 0, 0) for i in range(len(sr_descriptions))]
+    descriptions = [main_sat.band_desc()[bn] for bn in main_sat.res_to_bands()[min_res]] + sr_descriptions
+    gdal_utils.create_vrt(vrt_path=vrt_path,
+                          xsize=coord['xmax'] - coord['xmin'] + 1,
+                          ysize=coord['ymax'] - coord['ymin'] + 1,
+                          sources=sources,
+                          descriptions=descriptions,
+                          geotransform=tuple(geot),
+                          geoprojection=coord['geoprojection'])
 
-    # Check image
-    if not np.any(data_bands[min_res]):
-        raise Exception('The selected region is empty.')
 
-    # Compute mask of fill_values and set fill_values--> min_values for processing
-    mask = {}
-    for res, bands in data_bands.items():
-        mask[res] = (bands == main_sat.fill_val())
-        bands[mask[res]] = main_sat.min_val()
+def test(tile_path, max_res=None, output_path=None, roi_x_y=None, roi_lon_lat=None, copy_original_bands=True,
+         output_file_format='GTiff', window_size=None, batch_size=None, memory_budget=1024, prefetch_workers=1,
+         num_processes=1, precision='float32', bands_dir=None, trim_roi=False, output_dtype='float64',
+         output_compression='DEFLATE', output_tiled=True, output_threads=0, original_bands_vrt=False):
 
-    # Perform super-resolution
-    sr_bands = {res: None for res in sr_resolutions}
-    for res in sr_bands.keys():
-        print('Super resolving {}m ...'.format(res))
-        tmp_bands = {tmp_res: bands for tmp_res, bands in data_bands.items() if tmp_res <= res}
-        min_side = min(tmp_bands[res].shape[:2])
-        tmp_patchsize = min(main_sat.patch_sizes()[res], min_side)
-        sr_bands[res] = super_resolve(data_bands=tmp_bands, model=models[res],
-                                      patch_size=tmp_patchsize, border=main_sat.borders()[res])
+    # Check resolutions
+    sat_resolutions = list(main_sat.res_to_bands().keys())
+    min_res = min(sat_resolutions)
+    sr_resolutions = get_sr_resolutions(max_res)
+    max_res = max(sr_resolutions)
 
-    # Replace back with fill_values the original bands
-    for res, bands in data_bands.items():
-        data_bands[res][mask[res]] = main_sat.fill_val()
+    # Models are loaded on demand (the runtime profile is set when their Tensorflow sessions are created)
+    check_runtime_profile()
 
-    # Replace back with fill_values the super-resolved bands
-    mean_mask = np.prod(mask[min_res], axis=2)  # most restrictive mask at the min_resolution (in case masks of bands at minimum are different).
-    for res, bands in sr_bands.items():
-        if (res % min_res) == 0:  # resolutions are multiples of one another
-            scale = int(res / min_res)
-            new_mask = np.repeat(np.repeat(mask[res], repeats=scale, axis=0),
-                                 repeats=scale, axis=1)
+    # Process output file name and format
+    if output_path is None:
+        print("Error: you must provide the name of an output file. I will set it identical to the input...")
+        output_name = os.path.split(tile_path)[1] + '.tif'
+        output_path = os.path.join(paths.get_test_dir(), 'outputs', output_name)
+
+    output_file_format, output_path = get_output_path(output_path, output_file_format)
+
+    # Write only the super-resolved bands and reference the original bands from a VRT
+    vrt_path = None
+    if copy_original_bands and original_bands_vrt:
+        if output_file_format == 'chunked':
+            print("The original bands can only be referenced from GDAL outputs, they will be copied instead")
         else:
-            new_mask = mean_mask
-        bands[new_mask] = main_sat.fill_val()
+            vrt_path, output_path = get_vrt_paths(output_path)
+            copy_original_bands = False
+
+    # Shrink the region of interest to its valid pixels
+    if trim_roi:
+        roi_x_y, roi_lon_lat = get_valid_roi(tile_path=tile_path, max_res=max_res, roi_x_y=roi_x_y,
+                                             roi_lon_lat=roi_lon_lat)
+
+    if window_size:
+        return test_windowed(tile_path=tile_path, sr_resolutions=sr_resolutions, max_res=max_res,
+                             output_path=output_path, roi_x_y=roi_x_y, roi_lon_lat=roi_lon_lat,
+                             copy_original_bands=copy_original_bands, output_file_format=output_file_format,
+                             window_size=window_size, batch_size=batch_size, memory_budget=memory_budget,
+                             prefetch_workers=prefetch_workers, num_processes=num_processes, precision=precision,
+                             bands_dir=bands_dir, output_dtype=output_dtype, output_compression=output_compression,
+                             output_tiled=output_tiled, output_threads=output_threads, vrt_path=vrt_path)
 
-    # # Keep only the values that where different from zero in the original array (filter with mask)
-    # mask = (data_bands[min_res][:, :, 0] != 0)
-    # sr_bands = {res: bands * mask[:, :, None] for res, bands in sr_bands.items()}
+    # Load bands
+    data_bands, coord = tile_cache.read_bands(tile_path=tile_path, max_res=max_res, roi_x_y=roi_x_y,
+                                              roi_lon_lat=roi_lon_lat, bands_dir=bands_dir)
 
-    # Join the non-empty super resolved bands
-    sr, validated_sr_bands = [], []
-    for k, v in sr_bands.items():
-        sr.append(v)
-        validated_sr_bands += main_sat.res_to_bands()[k]
-    sr = np.concatenate(sr, axis=2)
+    # Check image
+    if not np.any(data_bands[min_res]):
+        raise Exception('The selected region is empty.')
 
     # Create the lists of output variables to save
-    output_bands, output_desc, output_shortnames = [], [], []
+    output_desc, output_shortnames, band_offsets = [], [], {}
 
     if copy_original_bands:
         for bi, bn in enumerate(main_sat.res_to_bands()[min_res]):
-            output_bands.append(data_bands[min_res][:, :, bi])
             output_desc.append(main_sat.band_desc()[bn])
             output_shortnames.append(bn)
 
-    for bi, bn in enumerate(validated_sr_bands):
-        output_bands.append(sr[:, :, bi])
-        output_desc.append("SR" + main_sat.band_desc()[bn])
-        output_shortnames.append("SR" + bn)
-
-    # for bands in output_bands:
-    #     print(np.amin(bands), np.amax(bands))
+    for res in sr_resolutions:
+        band_offsets[res] = len(output_desc)
+        for bi, bn in enumerate(main_sat.res_to_bands()[res]):
+            output_desc.append("SR" + main_sat.band_desc()[bn])
+            output_shortnames.append("SR" + bn)
 
     # Translate the image upper left corner. We multiply x10 to transform from pixel position in the 10m_band to meters.
     geot = list(coord['geotransform'])
     geot[0] += coord['xmin'] * min_res
     geot[3] -= coord['ymin'] * min_res
 
-    # Save output
-    if output_file_format == "npz":
-        output_dict = dict(zip(output_shortnames,
-                               output_bands))
-        np.savez(output_path, **output_dict)
+    # Create the output file up front, so that the bands are written as soon as they are ready
+    output_ds = create_output(output_path=output_path,
+                              output_file_format=output_file_format,
+                              xsize=data_bands[min_res].shape[1],
+                              ysize=data_bands[min_res].shape[0],
+                              names=output_shortnames,
+                              descriptions=output_desc,
+                              geotransform=tuple(geot),
+                              geoprojection=coord['geoprojection'],
+                              native_dtype=data_bands[min_res].dtype,
+                              output_dtype=output_dtype,
+                              output_compression=output_compression,
+                              output_tiled=output_tiled,
+                              output_threads=output_threads)
+
+    def write_bands(bands, band_offset):
+        write_output(output_ds, bands=bands, band_offset=band_offset, overviews=(output_file_format == 'COG'))
+
+    # The original bands are written before being modified by the super-resolution
+    if copy_original_bands:
+        write_bands([data_bands[min_res][:, :, bi] for bi in range(data_bands[min_res].shape[2])], band_offset=0)
+
+    # Perform super-resolution, writing the bands of each resolution as soon as they are super-resolved
+    def write_sr_bands(res, bands):
+        print('Saving the {}m super-resolved bands ...'.format(res))
+        write_bands([bands[:, :, bi] for bi in range(bands.shape[2])], band_offset=band_offsets[res])
 
-    else:
-        gdal_utils.save_gdal(output_path=output_path,
-                             bands=output_bands,
-                             descriptions=output_desc,
-                             geotransform=tuple(geot),
-                             geoprojection=coord['geoprojection'],
-                             file_format=output_file_format)
+    super_resolve_region(data_bands=data_bands, sr_resolutions=sr_resolutions, batch_size=batch_size,
+                         memory_budget=memory_budget, prefetch_workers=prefetch_workers, num_processes=num_processes,
+                         precision=precision, output_fn=write_sr_bands)
+
+    # Close the output file
+    close_output(output_ds, output_path=output_path, output_file_format=output_file_format,
+                 output_compression=output_compression, output_threads=output_threads, overviews_written=True)
+    output_ds = None
+
+    if vrt_path is not None:
+        create_stacked_vrt(vrt_path=vrt_path, sr_path=output_path, coord=coord, sr_descriptions=output_desc)
+        return vrt_path
+
+    return output_path
+
+
+def test_windowed(tile_path, sr_resolutions, max_res, output_path, roi_x_y=None, roi_lon_lat=None,
+                  copy_original_bands=True, output_file_format='GTiff', window_size=2048, batch_size=None,
+                  memory_budget=1024, prefetch_workers=1, num_processes=1, precision='float32', bands_dir=None,
+                  output_dtype='float64', output_compression='DEFLATE', output_tiled=True, output_threads=0,
+                  vrt_path=None):
+    """
+    Out-of-core version of `test()`. The region of interest is processed in windows of `window_size` pixels (at the
+    minimal resolution) which are read, super-resolved and written straight into the output file, so that the peak
+    memory depends on the window size and not on the size of the region of interest.
+
+    Each window is read with an additional halo of `border` pixels on each side (taken from the neighbouring
+    windows) so that the patches at the window edges see the same context as they would in the full image.
+
+    If `prefetch_workers > 0`, reading, super-resolution and writing of consecutive windows are overlapped.
+
+    The output file is created when the first window is read, as the native data type of the bands is needed.
+
+    If `vrt_path` is given, a VRT stacking the original bands (referenced from the tile) and the super-resolved bands
+    of the output file is created at that path and returned.
+    """
+    min_res = min(main_sat.res_to_bands().keys())
+
+    # Windows must be aligned with the pixels of the coarsest resolution
+    mult = max(main_sat.upscaling_factor().values())
+    halo = max(main_sat.borders()[res] for res in sr_resolutions)
+    halo = int(ceil(halo / mult)) * mult
+    window_size = max(int(window_size / mult), 1) * mult
+    min_size = max(main_sat.patch_sizes()[res] for res in sr_resolutions)
+
+    # Compute the region of interest without loading any band
+    _, roi = main_sat.read_bands()(tile_path=tile_path, max_res=max_res, roi_x_y=roi_x_y, roi_lon_lat=roi_lon_lat,
+                                   load_data=False)
+    xsize = roi['xmax'] - roi['xmin'] + 1
+    ysize = roi['ymax'] - roi['ymin'] + 1
+
+    # List the output bands
+    output_bands, output_desc, output_shortnames = [], [], []
+    if copy_original_bands:
+        for bi, bn in enumerate(main_sat.res_to_bands()[min_res]):
+            output_bands.append(('original', min_res, bi))
+            output_desc.append(main_sat.band_desc()[bn])
+            output_shortnames.append(bn)
+
+    for res in sr_resolutions:
+        for bi, bn in enumerate(main_sat.res_to_bands()[res]):
+            output_bands.append(('sr', res, bi))
+            output_desc.append("SR" + main_sat.band_desc()[bn])
+            output_shortnames.append("SR" + bn)
+
+    geot = list(roi['geotransform'])
+    geot[0] += roi['xmin'] * min_res
+    geot[3] -= roi['ymin'] * min_res
+
+    output_ds = None
+    empty = True  # whether all the windows read so far are empty
+
+    def read_window(window):
+        # Load the window with its halo (the halo never exceeds the region of interest)
+        (x0, x1), (y0, y1) = window
+        win_roi = [max(x0 - halo, roi['xmin']), max(y0 - halo, roi['ymin']),
+                   min(x1 + halo, roi['xmax'] + 1), min(y1 + halo, roi['ymax'] + 1)]
+        return tile_cache.read_bands(tile_path=tile_path, max_res=max_res, roi_x_y=win_roi, bands_dir=bands_dir)
+
+    def write_window(win_bands, xoff, yoff):
+        write_output(output_ds, bands=win_bands, xoff=xoff, yoff=yoff)
+
+    # Process the region of interest window by window.
+    # The next window is read while the current one is super-resolved, and finished windows are written in the
+    # background.
+    windows = [(x, y)
+               for y in get_windows(roi['ymin'], roi['ymax'] + 1, window_size, min_size)
+               for x in get_windows(roi['xmin'], roi['xmax'] + 1, window_size, min_size)]
+
+    threaded = prefetch_workers > 0
+    loaded_windows = prefetch_map(read_window, windows, workers=int(threaded), max_queue=1)
+    writer = AsyncWriter(max_queue=1, threaded=threaded)
+    try:
+        for i, (window, (data_bands, coord)) in enumerate(zip(windows, loaded_windows)):
+            (x0, x1), (y0, y1) = window
+            print('Processing window {}/{}: x=[{}, {}), y=[{}, {})'.format(i + 1, len(windows), x0, x1, y0, y1))
+            if output_ds is None:
+                output_ds = create_output(output_path=output_path,
+                                          output_file_format=output_file_format,
+                                          xsize=xsize,
+                                          ysize=ysize,
+                                          names=output_shortnames,
+                                          descriptions=output_desc,
+                                          geotransform=tuple(geot),
+                                          geoprojection=roi['geoprojection'],
+                                          native_dtype=data_bands[min_res].dtype,
+                                          output_dtype=output_dtype,
+                                          output_compression=output_compression,
+                                          output_tiled=output_tiled,
+                                          output_threads=output_threads)
+
+            # Crop the halo and check the window (before the bands are modified by the super-resolution)
+            crop_y = slice(y0 - coord['ymin'], y1 - coord['ymin'])
+            crop_x = slice(x0 - coord['xmin'], x1 - coord['xmin'])
+            empty = empty and not np.any(data_bands[min_res][crop_y, crop_x])
+
+            sr_bands = super_resolve_region(data_bands=data_bands, sr_resolutions=sr_resolutions,
+                                            batch_size=batch_size, memory_budget=memory_budget,
+                                            prefetch_workers=prefetch_workers, num_processes=num_processes,
+                                            precision=precision)
+
+            # Write the window
+            win_bands = []
+            for source, res, bi in output_bands:
+                tmp_bands = data_bands[res] if source == 'original' else sr_bands[res]
+                win_bands.append(tmp_bands[crop_y, crop_x, bi])
+
+            writer.submit(write_window, win_bands, xoff=x0 - roi['xmin'], yoff=y0 - roi['ymin'])
+    finally:
+        writer.close()
+
+    # Close the output file
+    close_output(output_ds, output_path=output_path, output_file_format=output_file_format,
+                 output_compression=output_compression, output_threads=output_threads)
+    output_ds = None
+
+    # Same check as in `test()`, which can only be done once all the windows have been read
+    if empty:
+        if os.path.isdir(output_path):
+            shutil.rmtree(output_path)
+        else:
+            os.remove(output_path)
+        raise Exception('The selected region is empty.')
+
+    if vrt_path is not None:
+        create_stacked_vrt(vrt_path=vrt_path, sr_path=output_path, coord=roi, sr_descriptions=output_desc)
+        return vrt_path
 
     return output_path
 
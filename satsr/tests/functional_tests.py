@@ -2,9 +2,28 @@
 File to run unit tests on the API
 """
 
+import copy
+import json
+from math import ceil
+import os
+import tarfile
+import tempfile
+import time
+
+import numpy as np
+from aiohttp.web import HTTPBadRequest
 from deepaas.model.v2.wrapper import UploadedFile
+from skimage.transform import resize
 
+from satsr import api, config
 from satsr.api import predict_data, predict_url
+from satsr.utils.chunk_store import ChunkStore
+from satsr.utils.DSen2Net import s2model
+from satsr.utils.frozen_model import fold_residual_scaling, freeze_model, FrozenModel
+from satsr.test_runfile import get_output_path
+from satsr.utils import result_cache
+from satsr.utils.job_queue import JobQueue
+from satsr.utils.patches import upsample_bands, recompose_images, get_test_patches
 
 
 def test_predict_url():
@@ -29,7 +48,229 @@ def test_predict_data():
     results = predict_data(args)
 
 
+def test_upsample_bands():
+    """
+    Check that the upsampling of the whole bands gives the same output as resizing each band with skimage.
+    """
+    rng = np.random.RandomState(0)
+    data_bands = {10: rng.uniform(size=(60, 48, 4)), 20: rng.uniform(size=(30, 24, 6)), 60: rng.uniform(size=(10, 8, 2))}
+    up_bands = upsample_bands(data_bands, chunk_size=16)
+    for res, bands in data_bands.items():
+        expected = np.stack([resize(image=bands[:, :, i], output_shape=(60, 48), mode='reflect')
+                             for i in range(bands.shape[2])], axis=2)
+        np.testing.assert_allclose(up_bands[res], expected, rtol=1e-5, atol=1e-6)
+
+
+def recompose_images_loop(a, border, size, positions):
+    """
+    Recompose an image patch by patch (reference for `test_recompose_images()`)
+    """
+    patch_size = a.shape[2] - border*2
+    x_tiles = int(ceil(size[1]/float(patch_size)))
+    y_tiles = int(ceil(size[0]/float(patch_size)))
+    images = np.zeros((a.shape[1], size[0], size[1])).astype(np.float32)
+    current_patch = 0
+    for y in range(0, y_tiles):
+        ypoint = min(y * patch_size, size[0] - patch_size)
+        for x in range(0, x_tiles):
+            xpoint = min(x * patch_size, size[1] - patch_size)
+            if y * x_tiles + x in positions:
+                images[:, ypoint:ypoint+patch_size, xpoint:xpoint+patch_size] = \
+                    a[current_patch, :, border:a.shape[2]-border, border:a.shape[3]-border]
+                current_patch += 1
+    return images.transpose((1, 2, 0))
+
+
+def test_recompose_images():
+    """
+    Check that the vectorised recomposition gives the same image as writing the patches one by one, either at once,
+    batch by batch or skipping some patches.
+    """
+    rng = np.random.RandomState(0)
+    size, border = (50, 45), 2
+    a = rng.uniform(size=(5 * 4, 3, 16, 16)).astype(np.float32)  # grid of 5x4 patches with an interior of 12x12 px
+    np.testing.assert_array_equal(recompose_images(a, border=border, size=size),
+                                  recompose_images_loop(a, border=border, size=size, positions=range(20)))
+
+    out = np.zeros(size + (3,), dtype=np.float32)
+    for start in range(0, 20, 7):
+        recompose_images(a[start:start + 7], border=border, size=size, out=out, start=start)
+    np.testing.assert_array_equal(out, recompose_images_loop(a, border=border, size=size, positions=range(20)))
+
+    positions = np.array([0, 1, 3, 6, 7, 8, 12, 15, 19])
+    out = np.zeros(size + (3,), dtype=np.float32)
+    for i in range(0, len(positions), 4):
+        recompose_images(a[positions[i:i + 4]], border=border, size=size, out=out, positions=positions[i:i + 4])
+    np.testing.assert_array_equal(out, recompose_images_loop(a[positions], border=border, size=size,
+                                                             positions=positions))
+
+
+def test_skip_nodata():
+    """
+    Check that only the patches whose interior has no data at all are skipped.
+    """
+    rng = np.random.RandomState(0)
+    data_bands = {10: rng.uniform(size=(60, 48, 4)), 20: rng.uniform(size=(30, 24, 6))}
+    nodata = np.ones((30, 24), dtype=bool)  # on the grid of the maximal resolution
+    nodata[5:9, 13:20] = False
+    nodata[29, 0] = False
+
+    patches = get_test_patches(data_bands, patch_size=16, border=2)
+    Q = patches.interior_size
+    expected = [k for k, (i, j) in enumerate(patches.origins) if not nodata[i:i + Q, j:j + Q].all()]
+    assert patches.skip_nodata(nodata) == len(patches.origins) - len(expected)
+    np.testing.assert_array_equal(patches.indices, expected)
+
+
+def test_frozen_model():
+    """
+    Check that the exported inference graph gives the same output as the Keras model it comes from.
+    """
+    input_shape = {'10': (4, None, None), '20': (6, None, None)}
+    model = s2model(input_shape, num_layers=6, feature_size=128)
+    graph_def, inputs, output = freeze_model(fold_residual_scaling(model, input_shape))
+    frozen = FrozenModel(graph_def, inputs=inputs, output=output)
+
+    rng = np.random.RandomState(0)
+    batch = {res: rng.uniform(size=(2, shape[0], 32, 32)).astype(np.float32) for res, shape in input_shape.items()}
+    np.testing.assert_allclose(frozen.predict_on_batch(batch), model.predict_on_batch(batch), rtol=1e-4, atol=1e-5)
+
+
+def test_chunk_store():
+    """
+    Check that windows written to a chunked store (not aligned with the chunks) are read back unchanged.
+    """
+    rng = np.random.RandomState(0)
+    bands = rng.randint(0, 2**16, size=(300, 200, 3)).astype(np.uint16)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        store = ChunkStore(tmp_dir, mode='w', xsize=200, ysize=300, names=['B1', 'B2', 'B3'],
+                           descriptions=['B1', 'B2', 'B3'], geotransform=(0, 10, 0, 0, 0, -10), geoprojection='',
+                           dtype='uint16', chunk_size=64)
+        for y0, y1 in [(0, 130), (130, 300)]:
+            for x0, x1 in [(0, 70), (70, 200)]:
+                store.write([bands[y0:y1, x0:x1, i] for i in range(3)], xoff=x0, yoff=y0)
+        store.close()
+
+        store = ChunkStore(tmp_dir)
+        np.testing.assert_array_equal(store.read_window(), bands)
+        np.testing.assert_array_equal(store.read_window(x0=50, y0=100, x1=150, y1=180, bands=['B3', 'B1']),
+                                      bands[100:180, 50:150][:, :, [2, 0]])
+
+
+def test_job_queue():
+    """
+    Check that the tasks of a batch job run in the background, failures are reported per task and the outputs of the
+    finished job are returned in a tar file.
+    """
+    def run_fn(task, output_root):
+        if task < 0:
+            raise ValueError('Invalid task')
+        with open(output_root + '.txt', 'w') as f:
+            f.write(str(task))
+        return output_root + '.txt'
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        queue = JobQueue(workers=2, jobs_dir=tmp_dir)
+        job_id = queue.submit([1, -1, 2], run_fn=run_fn)
+        while queue.status(job_id)['status'] in ['queued', 'running']:
+            time.sleep(0.1)
+
+        status = queue.status(job_id)
+        assert status['status'] == 'finished'
+        assert [task['status'] for task in status['tasks']] == ['finished', 'failed', 'finished']
+        assert status['tasks'][1]['error'] == 'Invalid task'
+        with tarfile.open(queue.result(job_id)) as tar:
+            assert sorted(m.name for m in tar.getmembers() if m.isfile()) == ['./0000.txt', './0002.txt']
+
+
+def test_predict_job():
+    """
+    Check that batch jobs are submitted, polled and retrieved through `predict()` with the media types of each reply.
+    The tiles are not processed, each task just writes its url to its output.
+    """
+    def process_url(url, conf_dict=None):
+        with open(conf_dict['testing']['output_path'], 'w') as f:
+            f.write(url)
+        return conf_dict['testing']['output_path']
+
+    urls = ['https://example.com/tile1.zip', 'https://example.com/tile2.zip']
+    args = {'urls': None, 'files': None, 'batch_jobs': json.dumps(urls), 'job_id': 'null', 'job_action': '"status"'}
+    original_process_url, original_job_queue = api.process_url, api.job_queue
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        api.process_url, api.job_queue = process_url, JobQueue(workers=2, jobs_dir=tmp_dir)
+        try:
+            job_id = api.predict(accept='application/json', **args)['job_id']
+
+            args.update({'batch_jobs': 'null', 'job_id': json.dumps(job_id)})
+            while api.predict(accept='application/json', **args)['status'] in ['queued', 'running']:
+                time.sleep(0.1)
+            assert api.predict(accept='application/json', **args)['status'] == 'finished'
+
+            args['job_action'] = '"result"'
+            with api.predict(accept='application/x-tar', **args) as f, tarfile.open(fileobj=f) as tar:
+                outputs = sorted(m.name for m in tar.getmembers() if m.isfile())
+                assert [tar.extractfile(name).read().decode() for name in outputs] == urls
+
+            # Invalid requests are rejected with a 400
+            for tmp_args in [dict(args, job_id='"unknown"', accept='application/x-tar'),
+                             dict(args, job_id='null', batch_jobs='[{"roi_x_y": [0, 0, 100, 100]}]',
+                                  accept='application/json')]:
+                try:
+                    api.predict(**tmp_args)
+                    assert False, 'The request should have been rejected'
+                except HTTPBadRequest:
+                    pass
+        finally:
+            api.process_url, api.job_queue = original_process_url, original_job_queue
+            api.update_user_conf({'batch_jobs': 'null', 'job_id': 'null', 'job_action': '"status"'})
+
+
+def test_result_cache_output_name():
+    """
+    Check that a cached output is returned with the same name as when it is computed. The tile is not processed, the
+    output is an empty chunked array store.
+    """
+    def test(tile_path, output_path, output_file_format, **kwargs):
+        output_file_format, output_path = get_output_path(output_path, output_file_format)
+        os.makedirs(output_path)
+        with open(os.path.join(output_path, 'index.json'), 'w') as f:
+            f.write('{}')
+        return output_path
+
+    original_test, original_cache_dir = api.test, result_cache.get_cache_dir
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        api.test, result_cache.get_cache_dir = test, lambda: os.path.join(tmp_dir, 'cache')
+        try:
+            os.makedirs(os.path.join(tmp_dir, 'tile'))
+            with open(os.path.join(tmp_dir, 'tile', 'band.txt'), 'w') as f:
+                f.write('band')
+            with tarfile.open(os.path.join(tmp_dir, 'tile.tar'), 'w') as tar:
+                tar.add(os.path.join(tmp_dir, 'tile'), arcname='tile')
+
+            conf_dict = copy.deepcopy(config.conf_dict)
+            conf_dict['testing'].update({'output_path': os.path.join(tmp_dir, 'output.tif'),
+                                         'output_file_format': 'chunked', 'result_cache_size': 10,
+                                         'tile_cache_size': 0})
+            output_paths = []
+            for _ in range(2):  # cache miss, then cache hit
+                with open(os.path.join(tmp_dir, 'tile.tar'), 'rb') as byte_stream:
+                    output_paths.append(api.process_archive(byte_stream, file_format='tar', conf_dict=conf_dict))
+                assert os.path.isfile(output_paths[-1])
+                os.remove(output_paths[-1])
+            assert output_paths[0] == output_paths[1] == os.path.join(tmp_dir, 'output.chunks.tar')
+        finally:
+            api.test, result_cache.get_cache_dir = original_test, original_cache_dir
+
+
 if __name__ == '__main__':
     pass
     # test_predict_data()
     # test_predict_url()
+    # test_upsample_bands()
+    # test_recompose_images()
+    # test_skip_nodata()
+    # test_frozen_model()
+    # test_chunk_store()
+    # test_job_queue()
+    # test_predict_job()
+    # test_result_cache_output_name()
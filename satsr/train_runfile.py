@@ -22,7 +22,7 @@ import keras.backend as K
 
 from satsr import paths, config, main_sat
 from satsr.utils.DSen2Net import s2model
-from satsr.utils import misc, data_utils, model_utils
+from satsr.utils import misc, data_utils, model_utils, runtime_utils
 
 # TODO list: HIGH priority
 # ========================
@@ -92,8 +92,11 @@ def train_fn(TIMESTAMP, CONF):
     paths.timestamp = TIMESTAMP
     max_res = CONF['training']['max_res']
 
-    # Dynamically grow the memory used on the GPU
-    tf_config = tf.ConfigProto()
+    # Dynamically grow the memory used on the GPU and set the CPU threads of the runtime profile
+    runtime_profile = runtime_utils.get_runtime_profile(conf=CONF)
+    runtime_utils.set_env_vars(runtime_profile)
+    tf_config = tf.ConfigProto(intra_op_parallelism_threads=runtime_profile['intra_op_threads'] or 0,
+                               inter_op_parallelism_threads=runtime_profile['inter_op_threads'] or 0)
     tf_config.gpu_options.allow_growth = True
     sess = tf.Session(config=tf_config)
     set_session(sess)
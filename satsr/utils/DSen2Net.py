@@ -1,5 +1,7 @@
 from __future__ import division
 
+import threading
+
 from keras.models import Model, Input
 from keras.layers import Conv2D, Concatenate, Activation, Lambda, Add
 from keras import backend as K
@@ -7,23 +9,32 @@ from keras import backend as K
 
 K.set_image_data_format('channels_first')
 
+# Keras takes the float type of the weights from a global setting, so models are built one at a time (they can be
+# built from several threads, and with different float types)
+build_lock = threading.Lock()
+
 
 def resBlock(x, channels, kernel_size=[3, 3], scale=0.1):
     tmp = Conv2D(channels, kernel_size, kernel_initializer='he_uniform', padding='same')(x)
     tmp = Activation('relu')(tmp)
     tmp = Conv2D(channels, kernel_size, kernel_initializer='he_uniform', padding='same')(tmp)
-    tmp = Lambda(lambda x: x * scale)(tmp)
+    if scale is not None:  # None when the scaling is folded into the conv weights (see `fold_residual_scaling()`)
+        tmp = Lambda(lambda x: x * scale)(tmp)
 
     return Add()([x, tmp])
 
 
-def s2model(input_shapes, num_layers=32, feature_size=256):
+def s2model(input_shapes, num_layers=32, feature_size=256, res_scale=0.1, dtype=None):
     """
     Parameters
     ----------
     input_shapes : dict
     num_layers : int
     feature_size : int
+    res_scale : float
+        Scaling of the residual blocks. If None the blocks are built without the scaling layer.
+    dtype : str
+        Float type of the model (by default the one of Keras)
 
     Returns
     -------
@@ -34,6 +45,16 @@ def s2model(input_shapes, num_layers=32, feature_size=256):
     Original paper by Laharas et al also had a deep version with (num_layers=32, feature_size=256) although we disable
     default as the performance gains were minor in comparison with the shallow one.
     """
+    with build_lock:
+        floatx = K.floatx()
+        K.set_floatx(dtype or floatx)
+        try:
+            return build_model(input_shapes, num_layers=num_layers, feature_size=feature_size, res_scale=res_scale)
+        finally:
+            K.set_floatx(floatx)
+
+
+def build_model(input_shapes, num_layers, feature_size, res_scale):
 
     input_list = []
     for res, shape in input_shapes.items(): # .items sorts by key values (unlike .iteritems)
@@ -43,7 +64,7 @@ def s2model(input_shapes, num_layers=32, feature_size=256):
     x = Conv2D(feature_size, (3, 3), kernel_initializer='he_uniform', activation='relu', padding='same')(x)
 
     for i in range(num_layers):
-        x = resBlock(x, feature_size)
+        x = resBlock(x, feature_size, scale=res_scale)
 
     x = Conv2D(int(input_list[-1].shape[1]), (3, 3), kernel_initializer='he_uniform', padding='same')(x)
     # x = Dropout(0.3)(x)
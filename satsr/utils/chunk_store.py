@@ -0,0 +1,166 @@
+"""
+Chunked array store, used as output format when GDAL cannot write the requested one.
+
+The output is a directory with:
+* `index.json`: shape, data type, chunk size, band names and descriptions, and the georeferencing of the bands,
+* one zlib-compressed file per band and spatial block (`<band>.<row>.<col>`, with the raw C-ordered pixels).
+The chunks are compressed in parallel by a pool of threads when they are written, and any window of the bands can be
+read afterwards by decompressing only the chunks it overlaps.
+
+Usage example:
+
+    store = ChunkStore('output.chunks')
+    window = store.read_window(x0=1000, y0=1000, x1=1500, y1=1500, bands=['SRB5', 'SRB6'])
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import zlib
+
+import numpy as np
+
+from satsr.utils.gdal_utils import encode_array
+
+
+class ChunkStore(object):
+
+    def __init__(self, path, mode='r', xsize=None, ysize=None, names=None, descriptions=None, geotransform=None,
+                 geoprojection=None, dtype='float32', scale=None, offset=None, chunk_size=512, compression_level=1,
+                 num_threads=0):
+        """
+        Parameters
+        ----------
+        path : str
+            Directory of the store
+        mode : str
+            'r' to read an existing store, 'w' to create a new one (the rest of parameters are only used then)
+        xsize, ysize : int
+            Width and height of the bands
+        names : list of strs
+            Short names of the bands
+        descriptions : list of strs
+        geotransform
+        geoprojection
+        dtype : str
+        scale, offset : floats
+            See `gdal_utils.get_output_dtype()`
+        chunk_size : int
+            Side (in pixels) of the chunks
+        compression_level : int
+            zlib compression level of the chunks
+        num_threads : int
+            Number of threads compressing the chunks (if 0 all the cores are used)
+        """
+        self.path = path
+        if mode == 'r':
+            with open(os.path.join(path, 'index.json'), 'r') as f:
+                self.index = json.load(f)
+        else:
+            os.makedirs(path, exist_ok=True)
+            self.index = {'shape': [ysize, xsize],
+                          'chunk_size': chunk_size,
+                          'dtype': np.dtype(dtype).name,
+                          'scale': scale,
+                          'offset': offset,
+                          'compression': 'zlib',
+                          'names': names,
+                          'descriptions': descriptions,
+                          'geotransform': list(geotransform),
+                          'geoprojection': geoprojection}
+            with open(os.path.join(path, 'index.json'), 'w') as outfile:
+                json.dump(self.index, outfile, indent=4)
+        self.dtype = np.dtype(self.index['dtype'])
+        self.compression_level = compression_level
+        self.pool = ThreadPoolExecutor(max_workers=num_threads or os.cpu_count()) if mode != 'r' else None
+
+    def get_chunk_path(self, band, row, col):
+        return os.path.join(self.path, '{}.{}.{}'.format(band, row, col))
+
+    def get_chunk_shape(self, row, col):
+        size = self.index['chunk_size']
+        height, width = self.index['shape']
+        return min(size, height - row * size), min(size, width - col * size)
+
+    def read_chunk(self, band, row, col):
+        """
+        Pixels of a chunk (zeros if it has not been written)
+        """
+        shape = self.get_chunk_shape(row, col)
+        chunk_path = self.get_chunk_path(band, row, col)
+        if not os.path.isfile(chunk_path):
+            return np.zeros(shape, dtype=self.dtype)
+        with open(chunk_path, 'rb') as f:
+            return np.frombuffer(zlib.decompress(f.read()), dtype=self.dtype).reshape(shape)
+
+    def write_chunk(self, band, row, col, data, y0, x0):
+        """
+        Write `data` at the position (y0, x0) of a chunk. Chunks partially covered by the data (eg. shared by
+        consecutive windows) are read, updated and rewritten.
+        """
+        shape = self.get_chunk_shape(row, col)
+        if data.shape == shape:
+            chunk = data
+        else:
+            chunk = np.array(self.read_chunk(band, row, col))
+            chunk[y0:y0 + data.shape[0], x0:x0 + data.shape[1]] = data
+        with open(self.get_chunk_path(band, row, col), 'wb') as f:
+            f.write(zlib.compress(np.ascontiguousarray(chunk).tobytes(), self.compression_level))
+
+    def write(self, bands, band_offset=0, xoff=0, yoff=0):
+        """
+        Write bands into a window of the store. Same parameters as `gdal_utils.write_gdal()`.
+        """
+        size = self.index['chunk_size']
+        futures = []
+        for i, band in enumerate(bands):
+            band = encode_array(band, dtype=self.dtype, scale=self.index['scale'], offset=self.index['offset'])
+            y1, x1 = yoff + band.shape[0], xoff + band.shape[1]
+            for row in range(yoff // size, (y1 - 1) // size + 1):
+                for col in range(xoff // size, (x1 - 1) // size + 1):
+                    # Part of the window inside the chunk
+                    cy0, cx0 = max(yoff, row * size), max(xoff, col * size)
+                    cy1, cx1 = min(y1, (row + 1) * size), min(x1, (col + 1) * size)
+                    data = band[cy0 - yoff:cy1 - yoff, cx0 - xoff:cx1 - xoff]
+                    futures.append(self.pool.submit(self.write_chunk, band_offset + i, row, col, data,
+                                                    cy0 - row * size, cx0 - col * size))
+        for future in futures:
+            future.result()
+
+    def read_window(self, x0=0, y0=0, x1=None, y1=None, bands=None):
+        """
+        Read a window of the store, decompressing only the chunks it overlaps
+
+        Parameters
+        ----------
+        x0, y0, x1, y1 : int
+            Window [x0, x1) x [y0, y1) in pixels (by default the whole bands)
+        bands : list of strs or ints
+            Names or indices of the bands to read (by default all of them)
+
+        Returns
+        -------
+        Numpy array (H, W, N) with the stored values (apply `scale` and `offset` of the index to get the pixel values)
+        """
+        height, width = self.index['shape']
+        y1 = height if y1 is None else min(y1, height)
+        x1 = width if x1 is None else min(x1, width)
+        if bands is None:
+            bands = range(len(self.index['names']))
+        bands = [self.index['names'].index(b) if isinstance(b, str) else b for b in bands]
+
+        size = self.index['chunk_size']
+        window = np.empty((y1 - y0, x1 - x0, len(bands)), dtype=self.dtype)
+        for i, band in enumerate(bands):
+            for row in range(y0 // size, (y1 - 1) // size + 1):
+                for col in range(x0 // size, (x1 - 1) // size + 1):
+                    cy0, cx0 = max(y0, row * size), max(x0, col * size)
+                    cy1, cx1 = min(y1, (row + 1) * size), min(x1, (col + 1) * size)
+                    chunk = self.read_chunk(band, row, col)
+                    window[cy0 - y0:cy1 - y0, cx0 - x0:cx1 - x0, i] = \
+                        chunk[cy0 - row * size:cy1 - row * size, cx0 - col * size:cx1 - col * size]
+        return window
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
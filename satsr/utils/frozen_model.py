@@ -0,0 +1,205 @@
+"""
+Export of the models to an optimized inference graph.
+
+The export removes from the Keras model everything that is only needed for training:
+* the scaling of the residual blocks is folded into the weights of the last convolution of each block,
+* the variables are converted into constants and the constant subgraphs are folded.
+The graph is saved next to the Keras weights (`./models/<satellite>_model_<res>m/ckpts/frozen_model.pb`) along with a
+json file with the names of the input and output tensors and the checksum of the weights it was exported from.
+
+Graphs can also be exported in reduced precision (`frozen_model_<precision>.pb`), trading some accuracy for speed:
+* float16: weights and activations are stored and computed in half precision,
+* int8: weights are quantized to 8 bits and the convolutions run with 8-bit kernels (activations are quantized on the
+  fly with their actual range).
+"""
+
+import json
+import os
+
+import numpy as np
+import tensorflow as tf
+from keras import backend as K
+from keras.layers import Conv2D
+
+from satsr import paths
+from satsr.utils.DSen2Net import s2model
+from satsr.utils.misc import file_checksum
+
+
+precisions = ['float32', 'float16', 'int8']
+
+
+def get_frozen_paths(modelname, precision='float32'):
+    """
+    Paths of the inference graph of a model and of its json description
+    """
+    ckpts_dir = os.path.join(paths.get_models_dir(), modelname, 'ckpts')
+    name = 'frozen_model' if precision == 'float32' else 'frozen_model_{}'.format(precision)
+    return os.path.join(ckpts_dir, name + '.pb'), os.path.join(ckpts_dir, name + '.json')
+
+
+def get_graph_size(graph_def):
+    """
+    Memory (in bytes) of the constants of an inference graph (ie. its weights, in whatever precision they are stored)
+    """
+    return sum(tf.make_ndarray(node.attr['value'].tensor).nbytes for node in graph_def.node if node.op == 'Const')
+
+
+def fold_residual_scaling(model, input_shape, num_layers=6, feature_size=128, res_scale=0.1, dtype=None):
+    """
+    Copy of a DSen2Net model where the scaling of each residual block is folded into the last convolution of the block
+    (ie. `scale * conv(x)` is computed as `conv'(x)` with `W' = scale * W` and `b' = scale * b`).
+
+    Parameters
+    ----------
+    model : Keras model
+    input_shape : dict
+    num_layers : int
+    feature_size : int
+    res_scale : float
+        Parameters used to build the model with `s2model()`
+    dtype : str
+        Float type of the new model (by default the one of Keras)
+
+    Returns
+    -------
+    Keras model
+    """
+    folded = s2model(input_shape, num_layers=num_layers, feature_size=feature_size, res_scale=None, dtype=dtype)
+    convs = [layer for layer in model.layers if isinstance(layer, Conv2D)]
+    folded_convs = [layer for layer in folded.layers if isinstance(layer, Conv2D)]
+    assert len(convs) == len(folded_convs) == 2 * num_layers + 2, "The model is not a DSen2Net model"
+
+    # Convolutions are: head, (first, last) for each residual block, tail
+    for i, (conv, folded_conv) in enumerate(zip(convs, folded_convs)):
+        weights = conv.get_weights()
+        if 0 < i <= 2 * num_layers and i % 2 == 0:
+            weights = [w * res_scale for w in weights]
+        folded_conv.set_weights(weights)
+    return folded
+
+
+def freeze_model(model):
+    """
+    Inference graph of a Keras model with the variables converted into constants and the constant subgraphs folded.
+
+    Returns
+    -------
+    graph_def : tf.GraphDef
+    inputs : dict
+        Names of the input tensors for each input of the model (ie. resolution)
+    output : str
+        Name of the output tensor
+    """
+    from tensorflow.tools.graph_transforms import TransformGraph
+
+    sess = K.get_session()
+    inputs = {name: t.name for name, t in zip(model.input_names, model.inputs)}
+    output_op = model.outputs[0].op.name
+    graph_def = tf.graph_util.convert_variables_to_constants(sess, sess.graph.as_graph_def(), [output_op])
+    graph_def = tf.graph_util.remove_training_nodes(graph_def, protected_nodes=[output_op])
+    graph_def = TransformGraph(graph_def,
+                               inputs=[t.split(':')[0] for t in inputs.values()],
+                               outputs=[output_op],
+                               transforms=['fold_constants(ignore_errors=true)', 'sort_by_execution_order'])
+    return graph_def, inputs, model.outputs[0].name
+
+
+def convert_model(model, input_shape, precision='float32'):
+    """
+    Inference graph of a Keras model in a given precision.
+
+    Returns
+    -------
+    Same as `freeze_model()`
+    """
+    from tensorflow.tools.graph_transforms import TransformGraph
+
+    assert precision in precisions, "Available precisions are {}".format(precisions)
+    dtype = 'float16' if precision == 'float16' else None
+    graph_def, inputs, output = freeze_model(fold_residual_scaling(model, input_shape, dtype=dtype))
+    if precision == 'int8':
+        graph_def = TransformGraph(graph_def,
+                                   inputs=[t.split(':')[0] for t in inputs.values()],
+                                   outputs=[output.split(':')[0]],
+                                   transforms=['quantize_weights', 'quantize_nodes',
+                                               'fold_constants(ignore_errors=true)', 'sort_by_execution_order'])
+    return graph_def, inputs, output
+
+
+class FrozenModel(object):
+    """
+    Model loaded from an inference graph. It runs in the current Keras session (so it uses the same runtime settings
+    as the Keras models) and has the same `predict_on_batch()` interface.
+    """
+
+    def __init__(self, graph_def, inputs, output, name='frozen_model'):
+        """
+        Parameters
+        ----------
+        graph_def : tf.GraphDef
+        inputs : dict
+        output : str
+            See `freeze_model()`
+        name : str
+            Name of the scope where the graph is imported
+        """
+        self.session = K.get_session()
+        self.input_names = sorted(inputs.keys(), key=int)
+        with self.session.graph.as_default():
+            tensors = tf.import_graph_def(graph_def, name=name,
+                                          return_elements=[inputs[k] for k in self.input_names] + [output])
+        self.inputs = dict(zip(self.input_names, tensors[:-1]))
+        self.output = tensors[-1]
+        self.nbytes = get_graph_size(graph_def)
+
+    def predict_on_batch(self, x):
+        """
+        Parameters
+        ----------
+        x : dict or list
+            Inputs of the model, either in a dict keyed by resolution or in a list sorted by resolution
+        """
+        if not isinstance(x, dict):
+            x = dict(zip(self.input_names, x))
+        output = self.session.run(self.output, feed_dict={self.inputs[k]: v for k, v in x.items()})
+        return output.astype(np.float32, copy=False)
+
+
+def export_model(model, input_shape, modelname, precision='float32'):
+    """
+    Export a Keras model (loaded from `final_model.h5`) to an inference graph in the folder of the model.
+    """
+    pb_path, json_path = get_frozen_paths(modelname, precision=precision)
+    weights_path = os.path.join(os.path.dirname(pb_path), 'final_model.h5')
+
+    graph_def, inputs, output = convert_model(model, input_shape, precision=precision)
+    with open(pb_path, 'wb') as f:
+        f.write(graph_def.SerializeToString())
+    with open(json_path, 'w') as outfile:
+        json.dump({'inputs': inputs, 'output': output, 'weights_checksum': file_checksum(weights_path)},
+                  outfile, sort_keys=True, indent=4)
+    print('Inference graph of {} saved to {}'.format(modelname, pb_path))
+
+
+def load_frozen_model(modelname, precision='float32'):
+    """
+    Load the inference graph of a model (None if it has not been exported or if it is older than the weights)
+    """
+    pb_path, json_path = get_frozen_paths(modelname, precision=precision)
+    if not (os.path.isfile(pb_path) and os.path.isfile(json_path)):
+        return None
+
+    with open(json_path, 'r') as f:
+        meta = json.load(f)
+    weights_path = os.path.join(os.path.dirname(pb_path), 'final_model.h5')
+    if os.path.isfile(weights_path) and (file_checksum(weights_path) != meta['weights_checksum']):
+        print('The inference graph of {} was exported from other weights. '
+              'Using the Keras model instead ...'.format(modelname))
+        return None
+
+    graph_def = tf.GraphDef()
+    with open(pb_path, 'rb') as f:
+        graph_def.ParseFromString(f.read())
+    return FrozenModel(graph_def, inputs=meta['inputs'], output=meta['output'],
+                       name='{}_{}'.format(modelname, precision))
@@ -9,8 +9,13 @@ Github: ignacioheredia
 
 import re
 import os
+from xml.etree import ElementTree
 
-from osgeo import gdal, osr
+import numpy as np
+from osgeo import gdal, gdal_array, osr
+
+
+compressions = ['NONE', 'DEFLATE', 'ZSTD', 'LZW']
 
 
 def print_gdal_file_formats():
@@ -73,6 +78,8 @@ def check_gdal_format(file_format):
     ----------
     file_format : str
     """
+    if file_format == 'COG':  # written through a temporary GTiff (see `close_gdal()`)
+        file_format = 'GTiff'
     driver = gdal.GetDriverByName(file_format)
     if driver:
         metadata = driver.GetMetadata()
@@ -82,21 +89,95 @@ def check_gdal_format(file_format):
         return False
 
 
-def save_gdal(output_path, bands, descriptions, geotransform, geoprojection, file_format='GTiff'):
+def get_output_dtype(output_dtype, native_dtype, min_val, max_val, fill_val):
     """
-    Function to save bands into a gdal format
+    Data type of the output bands, along with the scale and offset to store them with.
+
+    Parameters
+    ----------
+    output_dtype : str
+        'native' (data type of the bands read from the tile), 'int16' (values scaled to the range of the pixel values
+        of the satellite) or a numpy float type
+    native_dtype : numpy dtype
+    min_val, max_val, fill_val : numbers
+        Pixel values of the satellite
+
+    Returns
+    -------
+    dtype : str
+    scale, offset : floats
+        Values are stored as `(value - offset) / scale` (None if they are stored unscaled)
+    """
+    if output_dtype == 'native':
+        return np.dtype(native_dtype).name, None, None
+    if output_dtype == 'int16':
+        low, high = min(min_val, fill_val), max_val
+        scale = (high - low) / 65535.
+        return 'int16', scale, low + 32768 * scale  # low --> -32768, high --> 32767
+    return np.dtype(output_dtype).name, None, None
+
+
+def get_creation_options(file_format, dtype, compression=None, tiled=False, num_threads=0, block_size=256):
+    """
+    Creation options of a GDAL dataset (only GTiff options are supported)
+
+    Parameters
+    ----------
+    file_format : str
+    dtype : str
+    compression : str
+        One of `compressions`
+    tiled : bool
+        Whether to store the bands in tiles of `block_size` pixels instead of strips
+    num_threads : int
+        Number of threads used to compress the blocks (if 0 all the cores are used)
+    block_size : int
+    """
+    if file_format != 'GTiff':
+        return []
+    options = ['BIGTIFF=IF_SAFER', 'INTERLEAVE=BAND']  # bands are written one by one
+    if compression and compression != 'NONE':
+        predictor = 3 if np.issubdtype(np.dtype(dtype), np.floating) else 2
+        options += ['COMPRESS={}'.format(compression),
+                    'PREDICTOR={}'.format(predictor),
+                    'NUM_THREADS={}'.format(num_threads or 'ALL_CPUS')]
+    if tiled:
+        options += ['TILED=YES', 'BLOCKXSIZE={}'.format(block_size), 'BLOCKYSIZE={}'.format(block_size)]
+    return options
+
+
+def create_gdal(output_path, xsize, ysize, descriptions, geotransform, geoprojection, file_format='GTiff',
+                dtype='float64', scale=None, offset=None, compression=None, tiled=False, num_threads=0, nodata=None):
+    """
+    Create an empty gdal dataset so that the bands can be written afterwards window by window.
 
     Parameters
     ----------
     output_path : str
         Output path of the file
-    bands : list of 2D np.arrays
-        Bands to save. List of len(C)
+    xsize, ysize : int
+        Width and height of the output bands
     descriptions : list of strs
         Descriptions of the bands. List of len(C)
     geotransform
     geoprojection
     file_format
+        For 'COG' outputs, a temporary tiled GTiff is created and it is converted to a COG in `close_gdal()`.
+    dtype : str
+        Data type of the bands
+    scale, offset : floats
+        Scaling of the stored values (see `get_output_dtype()`). They are saved in the metadata of the bands.
+    compression : str
+    tiled : bool
+    num_threads : int
+        See `get_creation_options()`
+    nodata : number
+        Value of the pixels without data (eg. the fill value of the satellite). It is saved, once encoded, as the
+        nodata value of the bands, so that these pixels are left out of the overviews.
+
+    Returns
+    -------
+    GDAL Dataset
     """
     # Create output path if needed
     path_dir = os.path.dirname(output_path)
@@ -105,17 +186,312 @@ def save_gdal(output_path, bands, descriptions, geotransform, geoprojection, fil
 
     # Check file format
     assert check_gdal_format(file_format), 'File format not supported by GDAL (check https://www.gdal.org/formats_list.html)'
+    if file_format == 'COG':  # the compression is done when the COG is written
+        output_path, file_format, compression, tiled = get_tmp_path(output_path), 'GTiff', None, True
 
     # Create GDAL dataset
     driver = gdal.GetDriverByName(file_format)
     result_dataset = driver.Create(output_path,
-                                   bands[0].shape[1], bands[0].shape[0], len(bands),
-                                   gdal.GDT_Float64)
+                                   xsize, ysize, len(descriptions),
+                                   gdal_array.NumericTypeCodeToGDALTypeCode(np.dtype(dtype).type),
+                                   options=get_creation_options(file_format=file_format, dtype=dtype,
+                                                                compression=compression, tiled=tiled,
+                                                                num_threads=num_threads))
     result_dataset.SetGeoTransform(geotransform)
     result_dataset.SetProjection(geoprojection)
 
-    # Save bands and descriptions
+    if nodata is not None:
+        nodata = encode_array(np.array([nodata]), dtype=dtype, scale=scale, offset=offset)[0].item()
+
     for i, desc in enumerate(descriptions):
-        print('Saving {}'.format(desc))
-        result_dataset.GetRasterBand(i+1).SetDescription(desc)
-        result_dataset.GetRasterBand(i+1).WriteArray(bands[i])
+        raster_band = result_dataset.GetRasterBand(i+1)
+        raster_band.SetDescription(desc)
+        if scale is not None:
+            raster_band.SetScale(scale)
+            raster_band.SetOffset(offset)
+        if nodata is not None:
+            raster_band.SetNoDataValue(nodata)
+
+    return result_dataset
+
+
+def get_tmp_path(output_path):
+    return output_path + '.tmp.tif'
+
+
+def downsample_mean(band, valid=None):
+    """
+    Average the blocks of 2x2 pixels of a band (odd sides are padded by repeating the last row/column)
+
+    Parameters
+    ----------
+    band : 2D np.array
+    valid : 2D np.array of bools
+        Pixels with data. If given, only these pixels are averaged.
+
+    Returns
+    -------
+    Downsampled band, along with its valid pixels (blocks with some valid pixel) if `valid` is given
+    """
+    h, w = band.shape
+    if h % 2 or w % 2:
+        band = np.pad(band, ((0, h % 2), (0, w % 2)), mode='edge')
+        if valid is not None:
+            valid = np.pad(valid, ((0, h % 2), (0, w % 2)), mode='edge')
+    shape = (band.shape[0] // 2, 2, band.shape[1] // 2, 2)
+    if valid is None:
+        return band.reshape(shape).mean(axis=(1, 3), dtype=np.float32)
+
+    valid = valid.reshape(shape)
+    counts = valid.sum(axis=(1, 3))
+    sums = np.where(valid, band.reshape(shape), 0).sum(axis=(1, 3), dtype=np.float32)
+    return sums / np.maximum(counts, 1).astype(np.float32), counts > 0
+
+
+def get_overview_levels(dataset, block_size=256):
+    """
+    Overview factors of a dataset: 2, 4, 8, ... until the image fits in a block
+    """
+    levels, side = [], max(dataset.RasterXSize, dataset.RasterYSize)
+    while side > block_size:
+        levels.append(2 ** (len(levels) + 1))
+        side = -(-side // 2)
+    return levels
+
+
+def build_overviews(dataset):
+    """
+    Build the overviews of a dataset by averaging, reading the bands back from the file (GDAL leaves out the pixels
+    equal to the nodata value of the bands)
+    """
+    levels = get_overview_levels(dataset)
+    if levels:
+        dataset.BuildOverviews('AVERAGE', levels)
+
+
+def write_overviews(dataset, band, band_index):
+    """
+    Compute in memory the overviews of a whole band (each level is averaged from the previous one) and write them
+
+    Parameters
+    ----------
+    dataset : GDAL Dataset
+    band : 2D np.array
+    band_index : int
+        Index (1-based) of the band in the dataset
+    """
+    raster_band = dataset.GetRasterBand(band_index)
+    if raster_band.GetOverviewCount() == 0:
+        levels = get_overview_levels(dataset)
+        if not levels:
+            return
+        dataset.BuildOverviews('NONE', levels)  # only allocate the overviews (of all the bands)
+    nodata = raster_band.GetNoDataValue()
+    if nodata is None:
+        for k in range(raster_band.GetOverviewCount()):
+            band = downsample_mean(band)
+            raster_band.GetOverview(k).WriteArray(encode_band(band, raster_band))
+        return
+
+    # Pixels without data are left out of the averages, and blocks without any valid pixel are nodata
+    valid = encode_band(band, raster_band) != nodata
+    for k in range(raster_band.GetOverviewCount()):
+        band, valid = downsample_mean(band, valid)
+        overview = encode_band(band, raster_band)
+        raster_band.GetOverview(k).WriteArray(np.where(valid, overview, np.array(nodata, dtype=overview.dtype)))
+
+
+def translate_to_cog(dataset, output_path, compression=None, num_threads=0, block_size=256):
+    """
+    Copy a dataset with overviews into a Cloud-Optimized GeoTIFF
+    """
+    dtype = np.dtype(gdal_array.GDALTypeCodeToNumericTypeCode(dataset.GetRasterBand(1).DataType)).name
+    driver = gdal.GetDriverByName('COG')
+    if driver:
+        options = ['BLOCKSIZE={}'.format(block_size), 'BIGTIFF=IF_SAFER', 'OVERVIEWS=AUTO']  # reuse the overviews
+        if compression and compression != 'NONE':
+            options += ['COMPRESS={}'.format(compression),
+                        'PREDICTOR=YES',
+                        'NUM_THREADS={}'.format(num_threads or 'ALL_CPUS')]
+    else:  # GDAL < 3.1: a tiled GTiff with the overviews copied first has the same layout
+        driver = gdal.GetDriverByName('GTiff')
+        options = get_creation_options(file_format='GTiff', dtype=dtype, compression=compression, tiled=True,
+                                       num_threads=num_threads, block_size=block_size) + ['COPY_SRC_OVERVIEWS=YES']
+    driver.CreateCopy(output_path, dataset, options=options)
+
+
+def close_gdal(dataset, output_path, file_format='GTiff', compression=None, num_threads=0, overviews_written=False):
+    """
+    Finish writing a dataset created with `create_gdal()`. For COG outputs, the overviews are built, the temporary
+    GTiff is converted into the final file and it is closed and removed (the dataset can not be used afterwards).
+
+    Parameters
+    ----------
+    dataset : GDAL Dataset
+    output_path : str
+    file_format : str
+    compression : str
+    num_threads : int
+        See `get_creation_options()`
+    overviews_written : bool
+        Whether the overviews have already been written along with the bands (see `write_gdal()`)
+    """
+    if file_format == 'COG':
+        if not overviews_written:
+            print('Building overviews ...')
+            build_overviews(dataset)
+        dataset.FlushCache()
+        translate_to_cog(dataset, output_path, compression=compression, num_threads=num_threads)
+        close_dataset(dataset)
+        dataset = None
+        os.remove(get_tmp_path(output_path))
+    else:
+        dataset.FlushCache()
+
+
+def close_dataset(dataset):
+    """
+    Close a GDAL dataset so that its file is released. GDAL < 3.8 has no `Close()` and only closes a dataset when all
+    its references are dropped, so callers should drop theirs too.
+    """
+    if hasattr(dataset, 'Close'):
+        dataset.Close()
+    else:
+        dataset.FlushCache()
+
+
+def encode_band(band, raster_band):
+    """
+    Convert a band to the data type of a raster band, applying its scale and offset.
+    """
+    dtype = np.dtype(gdal_array.GDALTypeCodeToNumericTypeCode(raster_band.DataType))
+    return encode_array(band, dtype=dtype, scale=raster_band.GetScale(), offset=raster_band.GetOffset())
+
+
+def encode_array(band, dtype, scale=None, offset=None):
+    """
+    Convert a band to a data type, storing the values as `(value - offset) / scale`. Integer types are rounded and
+    clipped to their range.
+    """
+    dtype = np.dtype(dtype)
+    scale, offset = scale or 1., offset or 0.
+    if band.dtype == dtype and scale == 1. and offset == 0.:
+        return band
+    if scale != 1. or offset != 0.:
+        band = np.subtract(band, offset, dtype=np.float32)
+        band /= scale
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        band = np.clip(np.rint(band), info.min, info.max)
+    return band.astype(dtype, copy=False)
+
+
+def write_gdal(dataset, bands, band_offset=0, xoff=0, yoff=0, overviews=False):
+    """
+    Write bands into a window of an already created gdal dataset
+
+    Parameters
+    ----------
+    dataset : GDAL Dataset
+    bands : list of 2D np.arrays
+        Bands to write
+    band_offset : int
+        Index (0-based) of the dataset band where the first of the bands is written
+    xoff, yoff : int
+        Pixel position of the upper left corner of the window
+    overviews : bool
+        Whether to compute the overviews of the bands in memory and write them too (only for whole bands)
+    """
+    for i, band in enumerate(bands):
+        raster_band = dataset.GetRasterBand(band_offset + i + 1)
+        raster_band.WriteArray(encode_band(band, raster_band), xoff=xoff, yoff=yoff)
+        if overviews:
+            write_overviews(dataset, band, band_index=band_offset + i + 1)
+
+
+def save_gdal(output_path, bands, descriptions, geotransform, geoprojection, file_format='GTiff'):
+    """
+    Function to save bands into a gdal format
+
+    Parameters
+    ----------
+    output_path : str
+        Output path of the file
+    bands : list of 2D np.arrays
+        Bands to save. List of len(C)
+    descriptions : list of strs
+        Descriptions of the bands. List of len(C)
+    geotransform
+    geoprojection
+    file_format
+    """
+    result_dataset = create_gdal(output_path=output_path,
+                                 xsize=bands[0].shape[1],
+                                 ysize=bands[0].shape[0],
+                                 descriptions=descriptions,
+                                 geotransform=geotransform,
+                                 geoprojection=geoprojection,
+                                 file_format=file_format)
+
+    # Save bands
+    print('Saving {} bands to {}'.format(len(bands), output_path))
+    write_gdal(result_dataset, bands=bands, overviews=(file_format == 'COG'))
+    close_gdal(result_dataset, output_path=output_path, file_format=file_format, overviews_written=True)
+
+
+def create_vrt(vrt_path, xsize, ysize, sources, descriptions, geotransform, geoprojection):
+    """
+    Write a VRT stacking bands of other datasets, without copying their pixels.
+
+    Parameters
+    ----------
+    vrt_path : str
+        Output path of the VRT
+    xsize, ysize : int
+        Width and height of the VRT
+    sources : list of tuples
+        (dataset name, band number (1-based), xoff, yoff) of each band of the VRT. The window of size (xsize, ysize)
+        starting at (xoff, yoff) is taken from the source band. Dataset names that are files in the directory of the
+        VRT are written relative to it.
+    descriptions : list of strs
+        Descriptions of the bands. List of len(sources)
+    geotransform
+    geoprojection
+    """
+    vrt_dir = os.path.dirname(os.path.abspath(vrt_path))
+    root = ElementTree.Element('VRTDataset', rasterXSize=str(xsize), rasterYSize=str(ysize))
+    ElementTree.SubElement(root, 'SRS').text = geoprojection
+    ElementTree.SubElement(root, 'GeoTransform').text = ', '.join(repr(float(v)) for v in geotransform)
+
+    datasets = {}
+    for i, ((name, band_number, xoff, yoff), desc) in enumerate(zip(sources, descriptions)):
+        if name not in datasets:
+            datasets[name] = gdal.Open(name)
+        raster_band = datasets[name].GetRasterBand(band_number)
+
+        vrt_band = ElementTree.SubElement(root, 'VRTRasterBand', band=str(i + 1),
+                                          dataType=gdal.GetDataTypeName(raster_band.DataType))
+        ElementTree.SubElement(vrt_band, 'Description').text = desc
+        if raster_band.GetOffset():
+            ElementTree.SubElement(vrt_band, 'Offset').text = repr(raster_band.GetOffset())
+        if raster_band.GetScale() not in (None, 1.):
+            ElementTree.SubElement(vrt_band, 'Scale').text = repr(raster_band.GetScale())
+        if raster_band.GetNoDataValue() is not None:
+            ElementTree.SubElement(vrt_band, 'NoDataValue').text = repr(raster_band.GetNoDataValue())
+
+        if os.path.isfile(name):
+            name = os.path.abspath(name)
+            relative = os.path.dirname(name) == vrt_dir
+            if relative:
+                name = os.path.basename(name)
+        else:  # eg. a subdataset name
+            relative = False
+        source = ElementTree.SubElement(vrt_band, 'SimpleSource')
+        ElementTree.SubElement(source, 'SourceFilename', relativeToVRT=str(int(relative))).text = name
+        ElementTree.SubElement(source, 'SourceBand').text = str(band_number)
+        ElementTree.SubElement(source, 'SrcRect', xOff=str(xoff), yOff=str(yoff), xSize=str(xsize), ySize=str(ysize))
+        ElementTree.SubElement(source, 'DstRect', xOff='0', yOff='0', xSize=str(xsize), ySize=str(ysize))
+    datasets = None
+
+    print('Saving {} bands to {}'.format(len(sources), vrt_path))
+    ElementTree.ElementTree(root).write(vrt_path)
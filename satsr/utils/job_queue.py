@@ -0,0 +1,152 @@
+"""
+Queue of asynchronous batch prediction jobs.
+
+A job is a list of tasks (eg. tiles with their regions of interest) which are processed in the background by a pool of
+worker threads, so that the request submitting the job returns its id straight away instead of waiting for the whole
+batch. The pool bounds the number of tasks processed at the same time, whatever the number of jobs submitted.
+Outputs are saved in `./data/test/jobs/<job_id>/` (by default) and can be retrieved as a tar file once the job is finished. When
+there are more than `max_jobs` finished jobs, the oldest ones are removed along with their outputs.
+"""
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import os
+import shutil
+import threading
+import traceback
+import uuid
+
+from satsr import paths
+
+
+def get_jobs_dir():
+    return os.path.join(paths.get_test_dir(), 'jobs')
+
+
+class Job(object):
+
+    def __init__(self, tasks, jobs_dir):
+        self.id = uuid.uuid4().hex
+        self.dir = os.path.join(jobs_dir, self.id)
+        self.tasks = [{'task': task, 'status': 'queued', 'output': None, 'error': None} for task in tasks]
+        self.created = datetime.now()
+        self.finished = None
+
+    def count(self, status):
+        return sum(task['status'] == status for task in self.tasks)
+
+    def status(self):
+        if self.count('queued') + self.count('running') > 0:
+            return 'running' if self.count('queued') < len(self.tasks) else 'queued'
+        return 'failed' if self.count('failed') == len(self.tasks) else 'finished'
+
+    def info(self):
+        return {'job_id': self.id,
+                'status': self.status(),
+                'created': self.created.isoformat(),
+                'finished': self.finished.isoformat() if self.finished else None,
+                'progress': '{}/{}'.format(len(self.tasks) - self.count('queued') - self.count('running'),
+                                           len(self.tasks)),
+                'tasks': [{'task': task['task'],
+                           'status': task['status'],
+                           'output': os.path.basename(task['output']) if task['output'] else None,
+                           'error': task['error']} for task in self.tasks]}
+
+
+class JobQueue(object):
+
+    def __init__(self, workers=1, max_jobs=100, jobs_dir=None):
+        """
+        Parameters
+        ----------
+        workers : int
+            Maximum number of tasks processed at the same time
+        max_jobs : int
+            Maximum number of finished jobs kept
+        jobs_dir : str
+            Folder of the outputs of the jobs (by default `./data/test/jobs`)
+        """
+        self.max_jobs = max_jobs
+        self.jobs_dir = get_jobs_dir() if jobs_dir is None else jobs_dir
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def submit(self, tasks, run_fn):
+        """
+        Queue a job
+
+        Parameters
+        ----------
+        tasks : list
+            Tasks of the job
+        run_fn : callable
+            Function processing a task, called as `run_fn(task, output_root)`, where `output_root` is a path (without
+            extension) in the directory of the job which is unique to the task. It returns the path of the output.
+
+        Returns
+        -------
+        Id of the job
+        """
+        if not tasks:
+            raise ValueError('A job must have at least one task')
+        job = Job(tasks, jobs_dir=self.jobs_dir)
+        os.makedirs(job.dir)
+        with self.lock:
+            self.jobs[job.id] = job
+            self.evict()
+            for i in range(len(tasks)):
+                self.executor.submit(self.run_task, job, i, run_fn)
+        print('Queued job {} with {} tasks'.format(job.id, len(tasks)))
+        return job.id
+
+    def run_task(self, job, i, run_fn):
+        task = job.tasks[i]
+        task['status'] = 'running'
+        try:
+            result = {'output': run_fn(task['task'], os.path.join(job.dir, '{:04d}'.format(i))), 'status': 'finished'}
+        except Exception as e:
+            traceback.print_exc()
+            result = {'error': str(e), 'status': 'failed'}
+        with self.lock:  # the job is never seen as finished before its finishing time is set
+            task.update(result)
+            if job.finished is None and job.status() in ['finished', 'failed']:
+                job.finished = datetime.now()
+                print('Job {} {}'.format(job.id, job.status()))
+
+    def get(self, job_id):
+        with self.lock:
+            if job_id not in self.jobs:
+                raise KeyError('Unknown job id: {}'.format(job_id))
+            return self.jobs[job_id]
+
+    def status(self, job_id):
+        job = self.get(job_id)
+        with self.lock:
+            return job.info()
+
+    def result(self, job_id):
+        """
+        Path of a tar file with the outputs of the tasks of a finished job
+        """
+        job = self.get(job_id)
+        if job.finished is None:
+            raise Exception('Job {} is not finished yet ({})'.format(job_id, job.info()['progress']))
+        tar_path = job.dir + '.tar'
+        if not os.path.isfile(tar_path):
+            shutil.make_archive(job.dir, 'tar', root_dir=job.dir)
+        return tar_path
+
+    def evict(self):
+        finished = [job for job in self.jobs.values() if job.finished is not None]
+        for job in finished[:max(len(finished) - self.max_jobs, 0)]:
+            del self.jobs[job.id]
+            shutil.rmtree(job.dir, ignore_errors=True)
+            if os.path.isfile(job.dir + '.tar'):
+                os.remove(job.dir + '.tar')
+
+    def stats(self):
+        with self.lock:
+            statuses = [job.status() for job in self.jobs.values()]
+        return {status: statuses.count(status) for status in ['queued', 'running', 'finished', 'failed']}
@@ -1,7 +1,9 @@
 import os
 from distutils.dir_util import copy_tree
+import hashlib
 import io
 import tarfile
+import tempfile
 import zipfile
 import subprocess
 from multiprocessing import Process
@@ -90,6 +92,92 @@ def get_callbacks():
     return callback_list
 
 
+def stream_checksum(byte_stream, chunk_size=2**20):
+    """
+    MD5 checksum of a stream of bytes. The stream is rewound afterwards so that it can be read again.
+    """
+    md5 = hashlib.md5()
+    for chunk in iter(lambda: byte_stream.read(chunk_size), b''):
+        md5.update(chunk)
+    byte_stream.seek(0)
+    return md5.hexdigest()
+
+
+def file_checksum(path):
+    with open(path, 'rb') as f:
+        return stream_checksum(f)
+
+
+def download_to_file(resp, max_size=None, chunk_size=2**20, progress_fn=None, tmp_dir=None):
+    """
+    Stream the body of a response to a temporary file, chunk by chunk, so that the memory used does not depend on the
+    size of the download. The checksum is computed on the way.
+
+    Parameters
+    ----------
+    resp : requests.Response
+        Response of a request made with `stream=True`
+    max_size : int
+        Maximum size (in MB) of the download. If it is exceeded the download is aborted.
+    chunk_size : int
+        Size (in bytes) of the chunks
+    progress_fn : callable
+        Function called after each chunk as `progress_fn(downloaded, total)`, with the bytes downloaded so far and the
+        size of the download (None if the server doesn't provide it)
+    tmp_dir : str
+        Folder of the temporary file
+
+    Returns
+    -------
+    Temporary file with the downloaded bytes (rewound, and deleted when closed) and its MD5 checksum
+    """
+    total = resp.headers.get('content-length')
+    total = int(total) if total else None
+    max_bytes = max_size * 2**20 if max_size else None
+    if max_bytes and total and total > max_bytes:
+        resp.close()
+        raise ValueError('The file to download is larger than the maximum size ({} MB)'.format(max_size))
+
+    if tmp_dir is not None:
+        os.makedirs(tmp_dir, exist_ok=True)
+    f = tempfile.TemporaryFile(dir=tmp_dir)
+    md5, downloaded = hashlib.md5(), 0
+    try:
+        for chunk in iter(lambda: resp.raw.read(chunk_size), b''):
+            downloaded += len(chunk)
+            if max_bytes and downloaded > max_bytes:
+                raise ValueError('The downloaded file exceeds the maximum size ({} MB)'.format(max_size))
+            md5.update(chunk)
+            f.write(chunk)
+            if progress_fn is not None:
+                progress_fn(downloaded, total)
+    except BaseException:
+        f.close()
+        raise
+    finally:
+        resp.close()
+
+    f.seek(0)
+    return f, md5.hexdigest()
+
+
+def print_progress(step=100):
+    """
+    Progress function for `download_to_file()` printing the downloaded size every `step` MB
+    """
+    printed = [0]
+
+    def progress_fn(downloaded, total):
+        if downloaded // (step * 2**20) > printed[0] or downloaded == total:
+            printed[0] = downloaded // (step * 2**20)
+            if total:
+                print('Downloaded {:.0f}/{:.0f} MB ({:.0%})'.format(downloaded / 2**20, total / 2**20, downloaded / total))
+            else:
+                print('Downloaded {:.0f} MB'.format(downloaded / 2**20))
+
+    return progress_fn
+
+
 def open_compressed(byte_stream, file_format, output_folder):
     """
     Extract and save a stream of bytes of a compressed file from memory.
@@ -0,0 +1,158 @@
+"""
+Cache of the models kept in memory between predictions.
+
+Each model lives in its own Tensorflow graph and session, so that the models of several satellites can stay loaded at
+the same time and any of them can be released without rebuilding the others. When the models exceed the memory
+budget, the least recently used ones that are not being used by a prediction are released.
+"""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import threading
+
+from keras import backend as K
+
+
+def get_model_size(model):
+    """
+    Memory (in bytes) of the weights of a model
+    """
+    if hasattr(model, 'nbytes'):  # inference graphs
+        return model.nbytes
+    return sum(K.count_params(w) * w.dtype.base_dtype.size for w in model.weights)
+
+
+class CachedModel(object):
+    """
+    Model built in its own graph and session. It has the same `predict_on_batch()` interface as the Keras models.
+    """
+
+    def __init__(self, loader, tf_config=None):
+        """
+        Parameters
+        ----------
+        loader : callable
+            Function building the model
+        tf_config : tf.ConfigProto
+            Configuration of the session of the model
+        """
+        import tensorflow as tf
+
+        self.graph = tf.Graph()
+        self.session = tf.Session(graph=self.graph, config=tf_config)
+        with self.graph.as_default(), self.session.as_default():
+            self.model = loader()
+        self.nbytes = get_model_size(self.model)
+        self.users = 0  # number of predictions using the model
+        self.closing = False  # whether to close the model once it is no longer used
+
+    def predict_on_batch(self, x):
+        with self.graph.as_default(), self.session.as_default():
+            return self.model.predict_on_batch(x)
+
+    def close(self):
+        self.session.close()
+
+
+class ModelCache(object):
+    """
+    LRU cache of `CachedModel` instances with a memory budget.
+    """
+
+    def __init__(self, memory_budget=512):
+        """
+        Parameters
+        ----------
+        memory_budget : int
+            Memory (in MB) for the weights of the resident models. The most recently used model is always kept, even
+            if it is larger than the budget.
+        """
+        self.memory_budget = memory_budget
+        self.models = OrderedDict()
+        self.hits, self.misses, self.evictions = 0, 0, 0
+        self.lock = threading.Lock()
+        self.loading = {}  # events of the models being loaded
+
+    def __contains__(self, key):
+        return key in self.models
+
+    def get(self, key, loader, tf_config=None):
+        """
+        Get the model of a key, building it with `loader` if it is not in the cache. If the model is already being
+        built by another thread, wait for it instead of building it twice.
+        The model is marked as in use (so that it is not released from memory) until `release()` is called.
+        """
+        while True:
+            with self.lock:
+                if key in self.models:
+                    self.hits += 1
+                    self.models.move_to_end(key)
+                    self.models[key].users += 1
+                    return self.models[key]
+                if key not in self.loading:
+                    self.misses += 1
+                    self.loading[key] = threading.Event()
+                    break
+                event = self.loading[key]
+            event.wait()  # and check again, as the loading could have failed
+
+        # Other models can be used while this one is built
+        try:
+            model = CachedModel(loader, tf_config=tf_config)
+            with self.lock:
+                model.users += 1
+                self.models[key] = model
+                self.evict()
+            return model
+        finally:
+            with self.lock:
+                self.loading.pop(key).set()
+
+    def release(self, model):
+        with self.lock:
+            model.users -= 1
+            if model.closing and not model.users:
+                model.close()
+
+    @contextmanager
+    def use(self, key, loader, tf_config=None):
+        """
+        Context manager with the model of a key (see `get()`), which is released when exiting the context
+        """
+        model = self.get(key, loader, tf_config=tf_config)
+        try:
+            yield model
+        finally:
+            self.release(model)
+
+    def nbytes(self):
+        return sum(model.nbytes for model in self.models.values())
+
+    def evict(self):
+        for key in list(self.models.keys())[:-1]:  # the most recently used model is always kept
+            if self.nbytes() <= self.memory_budget * 2**20:
+                break
+            if self.models[key].users:
+                continue
+            self.models.pop(key).close()
+            self.evictions += 1
+            print('Releasing model {} from memory'.format(key))
+
+    def clear(self):
+        """
+        Remove all the models from the cache. Models in use are closed when they are released.
+        """
+        with self.lock:
+            for model in self.models.values():
+                if model.users:
+                    model.closing = True
+                else:
+                    model.close()
+            self.models.clear()
+
+    def stats(self):
+        return {'models': len(self.models),
+                'memory (MB)': round(self.nbytes() / 2**20, 1),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions}
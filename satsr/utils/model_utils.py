@@ -1,15 +1,61 @@
 from __future__ import division
+from collections import OrderedDict
 import os
 import json
+import multiprocessing
+import tempfile
 
 import numpy as np
+from tqdm import tqdm
 
 from satsr import paths, main_sat
 from satsr.utils.DSen2Net import s2model
-from satsr.utils.patches import recompose_images, get_test_patches
+from satsr.utils.frozen_model import load_frozen_model, convert_model, FrozenModel
+from satsr.utils.patches import recompose_images, get_test_patches, upsample_bands
+from satsr.utils.pipeline import prefetch_map, AsyncWriter
 
 
-def super_resolve(data_bands, model, patch_size=128, border=8):
+def get_batch_size(patch_size, channels, memory_budget, feature_size=128):
+    """
+    Number of patches per batch that fit in a memory budget.
+
+    Parameters
+    ----------
+    patch_size : int
+    channels : int
+        Number of input plus output channels of the model
+    memory_budget : int
+        Memory budget in MB
+    feature_size : int
+        Number of features of the hidden layers of the model (we keep an estimate of three alive at a time).
+    """
+    patch_bytes = 4 * patch_size**2 * (channels + 3 * feature_size)  # float32
+    return max(1, int(memory_budget * 2**20 // patch_bytes))
+
+
+def prepare_bands(data_bands):
+    """
+    Normalize the pixel values (in float32 format) and upsample the bands to the grid of the minimal resolution.
+    The output can be shared by the models of the different resolutions so that this is done only once per image.
+
+    Parameters
+    ----------
+    data_bands : dict
+
+    Returns
+    -------
+    Dict with the prepared bands
+    """
+    norm_bands = {}
+    for res, bands in data_bands.items():
+        # A single float32 copy of the bands, normalized in place
+        norm_bands[res] = np.subtract(bands, main_sat.min_val(), dtype=np.float32)
+        norm_bands[res] /= (main_sat.max_val() - main_sat.min_val())
+    return upsample_bands(norm_bands)
+
+
+def super_resolve(data_bands, model, patch_size=128, border=8, batch_size=None, memory_budget=1024, prepared=False,
+                  prefetch_workers=1, nodata=None):
     """
     Parameters
     ----------
@@ -17,40 +63,276 @@ def super_resolve(data_bands, model, patch_size=128, border=8):
     model : Keras model
     patch_size : int
     border : int
+    batch_size : int
+        Number of patches fed at once to the model. If None, it is computed from the memory budget.
+    memory_budget : int
+        Memory (in MB) for the patches and activations of a batch. Only used if batch_size is None.
+    prepared : bool
+        Whether data_bands have already been processed with `prepare_bands()`.
+    prefetch_workers : int
+        Number of threads preparing the next batches of patches while the model predicts the current one. The
+        recomposition of the predicted batches is also done in a background thread. If 0, all stages run sequentially.
+    nodata : numpy array
+        Boolean array (H, W) at the maximal resolution, True for the pixels without data. The patches whose output
+        only covers such pixels are not predicted and their output is left to the minimal pixel value (it is expected
+        to be overwritten with the fill value by the caller).
 
     Returns
     -------
     Numpy array with the super-resolved image
     """
-    # Normalize pixel values  and put image in float32 format
-    for res in data_bands.keys():
-        data_bands[res] = data_bands[res].astype(np.float32)
-        data_bands[res] = (data_bands[res] - main_sat.min_val()) / (main_sat.max_val() - main_sat.min_val())
+    resolutions = data_bands.keys()
+    max_res, min_res = max(resolutions), min(resolutions)
+
+    # Normalize pixel values, put image in float32 format and upsample to the minimal resolution
+    if not prepared:
+        data_bands = prepare_bands(data_bands)
 
-    # Get the patches and predict
-    patches = get_test_patches(data_bands=data_bands, patch_size=patch_size, border=border)
-    patches = {str(res): data for res, data in patches.items()}
-    prediction = model.predict(patches, verbose=1)
+    # Get the patches (they are generated batch by batch)
+    channels = sum(bands.shape[2] for bands in data_bands.values()) + data_bands[max_res].shape[2]
+    if batch_size is None:
+        batch_size = get_batch_size(patch_size=patch_size, channels=channels, memory_budget=memory_budget)
+    patches = get_test_patches(data_bands=data_bands, patch_size=patch_size, border=border, batch_size=batch_size,
+                               upsampled=True)
+    skipped = 0
+    if nodata is not None:
+        skipped = patches.skip_nodata(nodata)
+        print('Skipping {}/{} patches without data'.format(skipped, len(patches.origins)))
 
-    # Recompose the image from the patches
-    min_res = min(data_bands.keys())
-    images = recompose_images(prediction, border=border, size=data_bands[min_res].shape)
+    # Predict and recompose the image from the patches as each batch finishes.
+    # Patch preparation, prediction and recomposition of consecutive batches are overlapped.
+    size = data_bands[min_res].shape[:2]
+    empty = np.zeros if skipped else np.empty
+    images = empty(size + (data_bands[max_res].shape[2],), dtype=np.float32)
+    max_queue = prefetch_workers + 1
+    batches = prefetch_map(patches.__getitem__, range(len(patches)), workers=prefetch_workers, max_queue=max_queue)
+    writer = AsyncWriter(max_queue=max_queue, threaded=(prefetch_workers > 0))
+    try:
+        for i, batch in enumerate(tqdm(batches, total=len(patches))):
+            prediction = model.predict_on_batch(batch)
+            writer.submit(recompose_images, prediction, border=border, size=size, out=images,
+                          positions=patches.get_positions(i))
+    finally:
+        writer.close()
 
-    # Undo the pixel normalization and clip to allowed pixel values
-    images = images * (main_sat.max_val() - main_sat.min_val()) + main_sat.min_val()
-    images = np.clip(images, a_min=main_sat.min_val(), a_max=main_sat.max_val())
+    return denormalize_bands(images)
 
+
+def denormalize_bands(images):
+    """
+    Undo the pixel normalization and clip to allowed pixel values. This is done in place to avoid full-size
+    temporaries.
+    """
+    images *= (main_sat.max_val() - main_sat.min_val())
+    images += main_sat.min_val()
+    np.clip(images, a_min=main_sat.min_val(), a_max=main_sat.max_val(), out=images)
     return images
 
 
-def load_model(input_shape, modelname):
+# Pool of processes used for data-parallel inference, along with its number of workers
+pool = None
+pool_workers = None
+
+# Models of the current worker process (the most recently used ones last)
+worker_models = OrderedDict()
+max_worker_models = 2  # enough for all the resolutions super-resolved in a tile
+
+
+def get_tf_config(intra_op=0, inter_op=0, xla=False):
+    """
+    Configuration of a Tensorflow session with a given number of threads (0 means Tensorflow decides) and whether the
+    graphs are compiled with XLA.
+    """
+    import tensorflow as tf
+
+    tf_config = tf.ConfigProto(intra_op_parallelism_threads=intra_op,
+                               inter_op_parallelism_threads=inter_op)
+    if xla:
+        os.environ.setdefault('TF_XLA_FLAGS', '--tf_xla_cpu_global_jit')  # global JIT is only for GPUs by default
+        tf_config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+    return tf_config
+
+
+def set_tf_threads(intra_op=0, inter_op=0, xla=False):
+    """
+    Set the session of Keras in the current process (see `get_tf_config()`)
+    """
+    import tensorflow as tf
+    from keras.backend.tensorflow_backend import set_session
+
+    set_session(tf.Session(config=get_tf_config(intra_op=intra_op, inter_op=inter_op, xla=xla)))
+
+
+def init_worker(intra_op):
+    set_tf_threads(intra_op=intra_op, inter_op=1)
+
+
+def get_worker_model(model_args):
+    """
+    Get a model in a worker process, loading it the first time it is used. Only the `max_worker_models` most recently
+    used models are kept.
+    """
+    key = (model_args['modelname'], model_args.get('frozen'), model_args.get('precision'))
+    if key not in worker_models:
+        while len(worker_models) >= max_worker_models:
+            worker_models.popitem(last=False)
+        worker_models[key] = load_model(**model_args)
+    worker_models.move_to_end(key)
+    return worker_models[key]
+
+
+def get_pool(num_workers):
+    """
+    Get the pool of worker processes. There is at most one pool, which is kept alive between calls so that the models
+    are only loaded once per worker, and replaced when the number of workers changes.
+    """
+    global pool, pool_workers
+    if pool is None or pool_workers != num_workers:
+        close_pools()
+        intra_op = max(1, multiprocessing.cpu_count() // num_workers)  # split the cores among the workers
+        ctx = multiprocessing.get_context('spawn')  # forking a process with a Tensorflow session is unsafe
+        pool = ctx.Pool(processes=num_workers, initializer=init_worker, initargs=(intra_op,))
+        pool_workers = num_workers
+    return pool
+
+
+def close_pools():
+    global pool, pool_workers
+    if pool is not None:
+        pool.terminate()
+    pool, pool_workers = None, None
+
+
+def split_rows(n_rows, n_shards):
+    """
+    Split the rows of the patch grid into contiguous shards.
+    The last row of the grid overlaps with the previous one, so both are kept in the same shard to keep the output
+    deterministic.
+
+    Returns
+    -------
+    List of (start, stop) tuples
+    """
+    if n_rows < 2:
+        return [(0, n_rows)]
+    shards = [(int(s[0]), int(s[-1]) + 1) for s in np.array_split(np.arange(n_rows - 1), n_shards) if len(s)]
+    shards[-1] = (shards[-1][0], n_rows)
+    return shards
+
+
+def predict_shard(model_args, bands_paths, output_path, patch_size, border, batch_size, positions):
+    """
+    Predict the patches at some positions of the grid of an image and write them to the output. Runs inside a worker
+    process.
+    """
+    model = get_worker_model(model_args)
+    data_bands = {res: np.load(path, mmap_mode='r') for res, path in bands_paths.items()}
+    images = np.load(output_path, mmap_mode='r+')
+    patches = get_test_patches(data_bands=data_bands, patch_size=patch_size, border=border, batch_size=batch_size,
+                               upsampled=True)
+    for i in range(0, len(positions), batch_size):
+        batch_positions = positions[i:i + batch_size]
+        prediction = model.predict_on_batch(patches.get_patches_at(batch_positions))
+        recompose_images(prediction, border=border, size=images.shape[:2], out=images, positions=batch_positions)
+    images.flush()
+
+
+def super_resolve_parallel(data_bands, model_args, num_workers=2, patch_size=128, border=8, batch_size=None,
+                           memory_budget=1024, prepared=False, nodata=None):
+    """
+    Data-parallel version of `super_resolve()`. The rows of the patch grid are split among `num_workers` processes,
+    each one with its own copy of the model. The inputs and output are shared with the workers through memory-mapped
+    files.
+
+    Parameters
+    ----------
+    data_bands : dict
+    model_args : dict
+        Parameters to load the model in the workers (see `load_model()`)
+    num_workers : int
+    patch_size : int
+    border : int
+    batch_size : int
+    memory_budget : int
+    prepared : bool
+    nodata : numpy array
+        See `super_resolve()`
+
+    Returns
+    -------
+    Numpy array with the super-resolved image
+    """
+    resolutions = data_bands.keys()
+    max_res, min_res = max(resolutions), min(resolutions)
+
+    if not prepared:
+        data_bands = prepare_bands(data_bands)
+
+    channels = sum(bands.shape[2] for bands in data_bands.values()) + data_bands[max_res].shape[2]
+    if batch_size is None:
+        batch_size = get_batch_size(patch_size=patch_size, channels=channels, memory_budget=memory_budget)
+
+    # Split the grid of patches among the workers
+    patches = get_test_patches(data_bands=data_bands, patch_size=patch_size, border=border, upsampled=True)
+    n_rows, n_cols = patches.grid_shape
+    shards = split_rows(n_rows, num_workers)
+    if nodata is not None:
+        print('Skipping {}/{} patches without data'.format(patches.skip_nodata(nodata), len(patches.origins)))
+    bounds = np.searchsorted(patches.indices, [start * n_cols for start, _ in shards] + [n_rows * n_cols])
+
+    workers = get_pool(num_workers=num_workers)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        bands_paths = {}
+        for res, bands in data_bands.items():
+            bands_paths[res] = os.path.join(tmp_dir, '{}.npy'.format(res))
+            np.save(bands_paths[res], bands)
+
+        output_path = os.path.join(tmp_dir, 'output.npy')
+        size = data_bands[min_res].shape[:2]
+        images = np.lib.format.open_memmap(output_path, mode='w+', dtype=np.float32,
+                                           shape=size + (data_bands[max_res].shape[2],))
+        del images  # flush the header
+
+        results = [workers.apply_async(predict_shard, (model_args, bands_paths, output_path, patch_size, border,
+                                                       batch_size, patches.indices[i0:i1]))
+                   for i0, i1 in zip(bounds[:-1], bounds[1:]) if i1 > i0]
+        for r in tqdm(results):
+            r.get()
+
+        images = np.array(np.load(output_path, mmap_mode='r'))
+
+    return denormalize_bands(images)
+
+
+def load_model(input_shape, modelname, frozen=False, precision='float32'):
     """
     Load Keras model from weights
+
+    Parameters
+    ----------
+    input_shape : dict
+    modelname : str
+    frozen : bool
+        If True, load the optimized inference graph of the model if it has been exported (see
+        `satsr.utils.frozen_model`).
+    precision : str
+        Precision of the model (one of `satsr.utils.frozen_model.precisions`). Reduced precisions always use an
+        inference graph, which is converted from the weights if it has not been exported.
     """
-    paths.timestamp = modelname
-    model_path = os.path.join(paths.get_checkpoints_dir(), 'final_model.h5')
+    if frozen or (precision != 'float32'):
+        model = load_frozen_model(modelname, precision=precision)
+        if model is not None:
+            return model
+
+    # Models can be loaded from several threads so we don't rely on `paths.timestamp`
+    model_path = os.path.join(paths.get_models_dir(), modelname, 'ckpts', 'final_model.h5')
     model = s2model(input_shape, num_layers=6, feature_size=128)
     model.load_weights(model_path)
+
+    if precision != 'float32':
+        print('Converting {} to {} ...'.format(modelname, precision))
+        graph_def, inputs, output = convert_model(model, input_shape, precision=precision)
+        model = FrozenModel(graph_def, inputs=inputs, output=output, name='{}_{}'.format(modelname, precision))
     return model
 
 
@@ -4,10 +4,12 @@ from math import ceil
 import os
 
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
 import skimage.measure
 from skimage.transform import resize
 from scipy.ndimage.filters import gaussian_filter
 from tqdm import tqdm
+from keras.utils import Sequence
 
 from satsr import main_sat
 
@@ -38,6 +40,59 @@ def upsample_patches(lr_patch, output_shape):
     return up_patches
 
 
+def bilinear_weights(in_size, out_size):
+    """
+    Indices and weights of the bilinear interpolation along one axis. Equivalent to the one performed by
+    `skimage.transform.resize(order=1, mode='reflect')`.
+    """
+    coords = (np.arange(out_size) + 0.5) * (in_size / out_size) - 0.5
+    idx0 = np.floor(coords).astype(int)
+    weights = (coords - idx0).astype(np.float32)
+    idx = np.stack([idx0, idx0 + 1])
+    idx = np.abs(idx)  # reflect at the start
+    idx = np.where(idx > in_size - 1, 2 * (in_size - 1) - idx, idx)  # reflect at the end
+    return idx[0], idx[1], weights
+
+
+def upsample_bands(data_bands, chunk_size=256):
+    """
+    Make the bilinear upsampling of the bands of all resolutions to the grid of the minimal resolution.
+    This is done once for the whole image (instead of once per patch) so that the cost scales with the image area.
+
+    Parameters
+    ----------
+    data_bands : dict
+        Dict where the keys are int of the resolutions and values are numpy arrays (H, W, N)
+    chunk_size : int
+        Number of output rows interpolated at once. The intermediate arrays are only allocated for a chunk of rows, so
+        that the peak memory is close to the size of the output.
+
+    Returns
+    -------
+    Dict where the values are float32 numpy arrays with the (H, W) shape of the minimal resolution
+    """
+    min_res = min(data_bands.keys())
+    output_shape = data_bands[min_res].shape[:2]
+    up_bands = {}
+    for res, bands in data_bands.items():
+        if res == min_res:
+            up_bands[res] = bands
+            continue
+        # Separable bilinear interpolation (first along rows, then along columns)
+        i0, i1, wi = bilinear_weights(bands.shape[0], output_shape[0])
+        j0, j1, wj = bilinear_weights(bands.shape[1], output_shape[1])
+        bands = bands.astype(np.float32, copy=False)
+        up_bands[res] = np.empty(output_shape + bands.shape[2:], dtype=np.float32)
+        for r0 in range(0, output_shape[0], chunk_size):
+            rows = slice(r0, r0 + chunk_size)
+            tmp = bands[i0[rows]] * (1 - wi[rows])[:, None, None]
+            tmp += bands[i1[rows]] * wi[rows, None, None]
+            out = up_bands[res][rows]
+            np.multiply(tmp[:, j0], (1 - wj)[None, :, None], out=out)
+            out += tmp[:, j1] * wj[None, :, None]
+    return up_bands
+
+
 def downPixelAggr(img, SCALE=2):
     """
     Downsample image
@@ -61,69 +116,171 @@ def downPixelAggr(img, SCALE=2):
     return img_lr
 
 
-def get_test_patches(data_bands, patch_size=128, border=4, interp=True):
-    # For 20: patchSize=128, border=8
-    # For 60: patchSize=192, border=12
+def symmetric_indices(size, border):
+    """
+    Indices of an axis of length `size` mirrored `border` pixels at each side. Indexing an array with them is
+    equivalent to `np.pad(..., mode='symmetric')` without having to copy the array.
+    """
+    idx = np.arange(-border, size + border)
+    idx = np.where(idx < 0, -idx - 1, idx)
+    idx = np.where(idx >= size, 2 * size - idx - 1, idx)
+    return idx
 
-    resolutions = data_bands.keys()
-    max_res, min_res = max(resolutions), min(resolutions)
-    scales = {res: int(res/min_res) for res in resolutions}  # scale with respect to minimum resolution  e.g. {10: 1, 20: 2, 60: 6}
-    inv_scales = {res: int(max_res/res) for res in resolutions}  # scale with respect to maximum resolution e.g. {10: 6, 20: 3, 60: 1} or {10: 2, 20: 1}
 
-    # # Normalize pixel values
-    # for res in resolutions:
-    #     data_bands[res] = data_bands[res] / norm
-
-    # Adapt the borders and patchsizes for each scale
-    patch_size = int(patch_size/scales[max_res]) * scales[max_res]  # make patchsize compatible with all scales
-    borders = {res: border//scales[res] for res in resolutions}
-    patch_sizes = {res: (patch_size//scales[res], patch_size//scales[res]) for res in resolutions}
-
-    # Mirror the data at the borders to have the same dimensions as the input
-    padded_bands = {}
-    for res in resolutions:
-        tmp_border = border // scales[res]
-        padded_bands[res] = np.pad(data_bands[res], ((tmp_border, tmp_border), (tmp_border, tmp_border), (0, 0)), mode='symmetric')
-
-    # Compute the number of patches
-    P_i = padded_bands[max_res].shape[0] - 2 * borders[max_res]
-    P_j = padded_bands[max_res].shape[1] - 2 * borders[max_res]
-    Q_i = patch_sizes[max_res][0] - 2 * borders[max_res]
-    Q_j = patch_sizes[max_res][1] - 2 * borders[max_res]
-
-    patchesAlongi = P_i // Q_i
-    patchesAlongj = P_j // Q_j
-    nr_patches = (patchesAlongi + 1) * (patchesAlongj + 1)
-
-    range_i = np.arange(0, patchesAlongi) * Q_i
-    range_j = np.arange(0, patchesAlongj) * Q_j
-    if not np.mod(P_i, Q_i) == 0:
-        range_i = np.append(range_i, padded_bands[max_res].shape[0] - patch_sizes[max_res][0])
-    if not np.mod(P_j, Q_j) == 0:
-        range_j = np.append(range_j, padded_bands[max_res].shape[1] - patch_sizes[max_res][0])
-
-    # Save the patches
-    images = {res: np.zeros((nr_patches, padded_bands[res].shape[2]) + patch_sizes[res]).astype(np.float32) for res in resolutions}
-    pCount = 0
-    for ii in range_i.astype(int):
-        for jj in range_j.astype(int):
-            upper_left_i = ii
-            upper_left_j = jj
-            crop_point = [upper_left_i,
-                          upper_left_j,
-                          upper_left_i + patch_sizes[max_res][0],
-                          upper_left_j + patch_sizes[max_res][1]]
-            for res in resolutions:
-                tmp_crop_point = [p*inv_scales[res] for p in crop_point]
-                tmp_cr_image = padded_bands[res][tmp_crop_point[0]:tmp_crop_point[2], tmp_crop_point[1]:tmp_crop_point[3]]
-                images[res][pCount] = np.moveaxis(tmp_cr_image, source=2, destination=0)  # move to channels first
-            pCount += 1
-
-    if interp:
-        for res in resolutions:
-            images[res] = interp_patches(images[res], images[min_res].shape)
+def sliding_windows(arr, size):
+    """
+    Read-only view (no copy) of all the windows of `size` consecutive elements of a 1D array.
+    Returns an array of shape (len(arr) - size + 1, size).
+    """
+    return as_strided(arr, shape=(arr.shape[0] - size + 1, size), strides=(arr.strides[0], arr.strides[0]),
+                      writeable=False)
 
-    return images
+
+class patch_sequence(Sequence):
+    """
+    Keras Sequence with the inference patches of an image.
+    The bands are only mirrored virtually at the borders (through index maps) and patches are gathered batch by batch
+    when the model consumes them, so that we never hold a padded copy of the image nor all the patches in memory.
+    """
+
+    def __init__(self, data_bands, patch_size=128, border=4, batch_size=32, interp=True, upsampled=False):
+        """
+        Parameters
+        ----------
+        data_bands : dict
+            Dict where the keys are int of the resolutions and values are numpy arrays (H, W, N)
+        patch_size : int
+        border : int
+        batch_size : int
+        interp : bool
+            If True, all bands are upsampled (once for the whole image) to the minimal resolution so that all patches
+            have the patch size of the minimal resolution.
+        upsampled : bool
+            Whether the bands have already been upsampled to the minimal resolution (eg. with `upsample_bands()`).
+            Only used if interp is True.
+        """
+        # For 20: patchSize=128, border=8
+        # For 60: patchSize=192, border=12
+
+        resolutions = sorted(data_bands.keys())
+        max_res, min_res = max(resolutions), min(resolutions)
+        scales = {res: int(res/min_res) for res in resolutions}  # scale with respect to minimum resolution  e.g. {10: 1, 20: 2, 60: 6}
+        inv_scales = {res: int(max_res/res) for res in resolutions}  # scale with respect to maximum resolution e.g. {10: 6, 20: 3, 60: 1} or {10: 2, 20: 1}
+
+        # Adapt the borders and patchsizes for each scale
+        patch_size = int(patch_size/scales[max_res]) * scales[max_res]  # make patchsize compatible with all scales
+        borders = {res: border//scales[res] for res in resolutions}
+        patch_sizes = {res: patch_size//scales[res] for res in resolutions}
+
+        # Compute the upper left corner of the patches (in the padded image of the maximal resolution)
+        P_i, P_j = [side // scales[max_res] for side in data_bands[min_res].shape[:2]]
+        Q = patch_sizes[max_res] - 2 * borders[max_res]
+
+        range_i = np.arange(0, P_i // Q) * Q
+        range_j = np.arange(0, P_j // Q) * Q
+        if not np.mod(P_i, Q) == 0:
+            range_i = np.append(range_i, P_i - Q)
+        if not np.mod(P_j, Q) == 0:
+            range_j = np.append(range_j, P_j - Q)
+
+        ii, jj = np.meshgrid(range_i, range_j, indexing='ij')
+        self.origins = np.stack([ii.ravel(), jj.ravel()], axis=1).astype(int)
+        self.grid_shape = (len(range_i), len(range_j))
+        self.interior_size = Q
+        self.indices = np.arange(len(self.origins))  # positions in the grid of the patches to generate
+
+        # Upsample the bands before cutting the patches
+        if interp:
+            if not upsampled:
+                data_bands = upsample_bands(data_bands)
+            borders = {res: border for res in resolutions}
+            patch_sizes = {res: patch_size for res in resolutions}
+            inv_scales = {res: inv_scales[min_res] for res in resolutions}
+
+        # Windows of the (virtually) mirrored pixel indices for each patch position
+        self.row_windows, self.col_windows = {}, {}
+        for res in resolutions:
+            H, W = data_bands[res].shape[:2]
+            self.row_windows[res] = sliding_windows(symmetric_indices(H, borders[res]), patch_sizes[res])
+            self.col_windows[res] = sliding_windows(symmetric_indices(W, borders[res]), patch_sizes[res])
+
+        self.data_bands = data_bands
+        self.resolutions = resolutions
+        self.inv_scales = inv_scales
+        self.patch_size = patch_size
+        self.batch_size = batch_size
+
+    def __len__(self):
+        return int(np.ceil(len(self.indices) / float(self.batch_size)))
+
+    def __getitem__(self, idx):
+        return self.get_patches(idx * self.batch_size, (idx + 1) * self.batch_size)
+
+    def get_positions(self, idx):
+        """
+        Positions in the grid of the patches of the batch `idx`
+        """
+        return self.indices[idx * self.batch_size:(idx + 1) * self.batch_size]
+
+    def skip_nodata(self, nodata):
+        """
+        Skip the patches whose interior (ie. the part of the patch written to the output) only covers pixels without
+        data.
+
+        Parameters
+        ----------
+        nodata : numpy array
+            Boolean array (H, W) on the grid of the maximal resolution, True for the pixels without data.
+
+        Returns
+        -------
+        Number of skipped patches
+        """
+        valid = np.zeros((nodata.shape[0] + 1, nodata.shape[1] + 1), dtype=np.int64)  # summed-area table
+        valid[1:, 1:] = np.cumsum(np.cumsum(~nodata, axis=0), axis=1)
+        i, j, Q = self.origins[:, 0], self.origins[:, 1], self.interior_size
+        counts = valid[i + Q, j + Q] - valid[i, j + Q] - valid[i + Q, j] + valid[i, j]
+        self.indices = np.flatnonzero(counts > 0)
+        return len(self.origins) - len(self.indices)
+
+    def get_patches(self, start, stop):
+        """
+        Materialize the patches [start, stop) of the image (skipped patches are not counted).
+
+        Returns
+        -------
+        Dict where the keys are str of the resolutions and values are numpy arrays (N, C, H, W)
+        """
+        return self.get_patches_at(self.indices[start:stop])
+
+    def get_patches_at(self, positions):
+        """
+        Materialize the patches at some positions of the grid.
+
+        Returns
+        -------
+        Same as `get_patches()`
+        """
+        origins = self.origins[positions]
+        images = {}
+        for res in self.resolutions:
+            rows = self.row_windows[res][origins[:, 0] * self.inv_scales[res]]  # (N, H)
+            cols = self.col_windows[res][origins[:, 1] * self.inv_scales[res]]  # (N, W)
+            tmp_images = self.data_bands[res][rows[:, :, None], cols[:, None, :]]  # (N, H, W, C)
+            images[res] = np.ascontiguousarray(np.moveaxis(tmp_images, source=3, destination=1),  # move to channels first
+                                               dtype=np.float32)
+
+        return {str(res): data for res, data in images.items()}
+
+
+def get_test_patches(data_bands, patch_size=128, border=4, interp=True, batch_size=32, upsampled=False):
+    """
+    Returns
+    -------
+    Keras Sequence generating the patches batch by batch (see `patch_sequence`)
+    """
+    return patch_sequence(data_bands=data_bands, patch_size=patch_size, border=border, batch_size=batch_size,
+                          interp=interp, upsampled=upsampled)
 
 
 def save_random_patches(gt, lr, save_path, num_patches=None):
@@ -204,36 +361,59 @@ def save_random_patches(gt, lr, save_path, num_patches=None):
                 tmp_label)
 
 
-def recompose_images(a, border, size=None):
+def recompose_images(a, border, size=None, out=None, start=0, positions=None):
     """
     Recompose an image from the patches
+
+    Parameters
+    ----------
+    a : numpy array
+        Patches with shape (N, C, H, W)
+    border : int
+        Border of the patches to discard
+    size : tuple
+        Size (H, W) of the image to recompose
+    out : numpy array
+        Channels last array (H, W, C) where the patches are written (eg. a np.memmap). If None a new float32 array is
+        created.
+    start : int
+        Position of the first patch of `a` in the grid of patches of the image. This allows to recompose the image batch
+        by batch.
+    positions : numpy array
+        Positions of each patch of `a` in the grid of patches (by default consecutive positions from `start`). This
+        allows to recompose the image when some patches are skipped.
+
+    Returns
+    -------
+    Numpy array (H, W, C) with the image
     """
-    if a.shape[0] == 1:
-        images = a[0]
-    else:
-        # This is done because we do not mirror the data at the image border
-        patch_size = a.shape[2] - border*2
-        x_tiles = int(ceil(size[1]/float(patch_size)))
-        y_tiles = int(ceil(size[0]/float(patch_size)))
-
-        # Initialize image
-        images = np.zeros((a.shape[1], size[0], size[1])).astype(np.float32)
-        current_patch = 0
-        for y in range(0, y_tiles):
-            ypoint = y * patch_size
-            if ypoint > size[0] - patch_size:
-                ypoint = size[0] - patch_size
-            for x in range(0, x_tiles):
-                xpoint = x * patch_size
-                if xpoint > size[1] - patch_size:
-                    xpoint = size[1] - patch_size
-                images[:, ypoint:ypoint+patch_size, xpoint:xpoint+patch_size] = a[current_patch, :, border:a.shape[2]-border, border:a.shape[3]-border]
-                current_patch += 1
-
-    # # Undo the pixel values normalization
-    # images = images * norm
-    #
-    # # Clip the image to allowed pixel values
-    # images = np.clip(images, a_min=0, a_max=max_pixel)
-
-    return images.transpose((1, 2, 0))
+    # This is done because we do not mirror the data at the image border
+    patch_size = a.shape[2] - border*2
+    x_tiles = int(ceil(size[1]/float(patch_size)))
+
+    # Initialize image
+    if out is None:
+        out = np.zeros((size[0], size[1], a.shape[1]), dtype=np.float32)
+
+    # Process the patches in groups of consecutive positions in the same row of the grid. Each group is written in bulk
+    # into a (H, N, W, C) view of the output, except for the last patch of the row which is shifted to fit inside the
+    # image (and overlaps with the previous one).
+    interiors = a[:, :, border:a.shape[2]-border, border:a.shape[3]-border].transpose((2, 0, 3, 1))  # (H, N, W, C)
+    if positions is None:
+        positions = start + np.arange(a.shape[0])
+    rows = positions // x_tiles
+    breaks = np.flatnonzero((np.diff(positions) != 1) | (np.diff(rows) != 0)) + 1
+    for i0, i1 in zip(np.r_[0, breaks], np.r_[breaks, len(positions)]):
+        y, n = rows[i0], i1 - i0
+        x0 = positions[i0] % x_tiles
+        ypoint = min(y * patch_size, size[0] - patch_size)
+
+        n_regular = n - 1 if (x0 + n == x_tiles) else n
+        strip = out[ypoint:ypoint+patch_size, x0*patch_size:(x0+n_regular)*patch_size]
+        strip = as_strided(strip, shape=(patch_size, n_regular, patch_size, strip.shape[2]),
+                           strides=(strip.strides[0], patch_size * strip.strides[1]) + strip.strides[1:])
+        strip[:] = interiors[:, i0:i0+n_regular]
+        if n_regular < n:
+            out[ypoint:ypoint+patch_size, size[1]-patch_size:size[1]] = interiors[:, i0+n_regular]
+
+    return out
@@ -0,0 +1,97 @@
+"""
+Utils to overlap the different stages of the inference (reading, patch preparation, prediction and writing) using
+worker threads and bounded queues.
+Most of the heavy lifting of those stages (numpy copies, GDAL I/O, Tensorflow) releases the GIL, so threads are enough to
+keep the CPU cores that are not used by Tensorflow busy.
+"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import islice
+import queue
+import threading
+
+
+def prefetch_map(fn, items, workers=1, max_queue=2):
+    """
+    Lazy and ordered equivalent of `map(fn, items)` where the results are computed in advance by a pool of threads.
+
+    Parameters
+    ----------
+    fn : callable
+    items : iterable
+    workers : int
+        Number of threads. If 0 the results are computed on the fly in the calling thread.
+    max_queue : int
+        Maximum number of results computed ahead of the consumer (this bounds the memory used by the queue).
+    """
+    if workers == 0:
+        for item in items:
+            yield fn(item)
+        return
+
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = deque(executor.submit(fn, item) for item in islice(items, max(max_queue, workers)))
+        while futures:
+            result = futures.popleft().result()
+            for item in islice(items, 1):
+                futures.append(executor.submit(fn, item))
+            yield result
+
+
+class AsyncWriter(object):
+    """
+    Run jobs (typically writing results to memory or to disk) in a background thread, in the same order in which they
+    were submitted. At most `max_queue` jobs can be waiting, after that `submit()` blocks the producer instead of
+    piling up results in memory.
+    """
+
+    _stop = object()
+
+    def __init__(self, max_queue=2, threaded=True):
+        """
+        Parameters
+        ----------
+        max_queue : int
+        threaded : bool
+            If False, jobs are run directly in the calling thread when they are submitted.
+        """
+        self.threaded = threaded
+        self.error = None
+        if threaded:
+            self.queue = queue.Queue(maxsize=max_queue)
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is self._stop:
+                break
+            if self.error is None:  # after a failure we just drain the queue
+                try:
+                    job()
+                except Exception as e:
+                    self.error = e
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+
+    def submit(self, fn, *args, **kwargs):
+        self._check()
+        if self.threaded:
+            self.queue.put(partial(fn, *args, **kwargs))
+        else:
+            fn(*args, **kwargs)
+
+    def close(self):
+        """
+        Wait for all the submitted jobs to finish
+        """
+        if self.threaded:
+            self.queue.put(self._stop)
+            self.thread.join()
+        self._check()
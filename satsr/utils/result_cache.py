@@ -0,0 +1,117 @@
+"""
+Persistent cache of the outputs of the predictions.
+
+Outputs are stored in `./data/test/cache/results/<key>/` where the key is a hash of the content of the input archive,
+the parameters that change the output and the checksums of the weights of the models. Identical requests are then
+answered with the stored file instead of being processed again. When the cache grows larger than its size limit, the
+least recently used outputs are removed.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+from satsr import paths
+from satsr.utils.misc import file_checksum
+
+
+# Checksums of the model weights, indexed by (path, modification time)
+weights_checksums = {}
+
+
+def get_cache_dir():
+    return os.path.join(paths.get_test_dir(), 'cache', 'results')
+
+
+def weights_checksum(modelname):
+    weights_path = os.path.join(paths.get_models_dir(), modelname, 'ckpts', 'final_model.h5')
+    if not os.path.isfile(weights_path):
+        return None
+    key = (weights_path, os.path.getmtime(weights_path))
+    if key not in weights_checksums:
+        weights_checksums[key] = file_checksum(weights_path)
+    return weights_checksums[key]
+
+
+def get_key(archive_checksum, params, modelnames):
+    """
+    Key of the output of a request
+
+    Parameters
+    ----------
+    archive_checksum : str
+        Checksum of the input archive
+    params : dict
+        Parameters of the request that change the output
+    modelnames : list of strs
+        Models used to compute the output
+    """
+    content = {'archive': archive_checksum,
+               'params': params,
+               'models': {name: weights_checksum(name) for name in modelnames}}
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+
+def lookup(key):
+    """
+    Path of the cached output of a key (None if it is not in the cache)
+    """
+    entry_dir = os.path.join(get_cache_dir(), key)
+    if not os.path.isdir(entry_dir):
+        return None
+    files = os.listdir(entry_dir)
+    if not files:
+        return None
+    os.utime(entry_dir)  # mark the entry as recently used
+    return os.path.join(entry_dir, files[0])
+
+
+def store(key, output_path, max_size=1024):
+    """
+    Store the output of a key in the cache and evict the least recently used entries to keep the cache under
+    `max_size` MB.
+
+    Returns
+    -------
+    Path of the cached output
+    """
+    cache_dir = get_cache_dir()
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # Copy the output to a temporary folder first so that a half-written entry is never served
+    tmp_dir = tempfile.mkdtemp(dir=cache_dir, prefix='.tmp_')
+    shutil.copyfile(output_path, os.path.join(tmp_dir, os.path.basename(output_path)))
+
+    entry_dir = os.path.join(cache_dir, key)
+    try:
+        os.rename(tmp_dir, entry_dir)
+    except OSError:  # the same output was stored meanwhile
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    evict(max_size=max_size, keep=key)
+    return lookup(key)
+
+
+def evict(max_size, keep=None):
+    """
+    Remove the least recently used entries until the cache is under `max_size` MB
+    """
+    cache_dir = get_cache_dir()
+    entries = []
+    for key in os.listdir(cache_dir):
+        entry_dir = os.path.join(cache_dir, key)
+        if key.startswith('.') or not os.path.isdir(entry_dir):
+            continue
+        size = sum(os.path.getsize(os.path.join(entry_dir, f)) for f in os.listdir(entry_dir))
+        entries.append((os.path.getmtime(entry_dir), key, size))
+
+    total_size = sum(e[2] for e in entries)
+    for _, key, size in sorted(entries):
+        if total_size <= max_size * 2**20:
+            break
+        if key == keep:
+            continue
+        shutil.rmtree(os.path.join(cache_dir, key), ignore_errors=True)
+        total_size -= size
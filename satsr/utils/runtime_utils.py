@@ -0,0 +1,120 @@
+"""
+Runtime settings (CPU threads, OpenMP/MKL variables, graph optimizations and batch sizes) used to run the models.
+
+The settings come from the `runtime` group of the configuration. When `runtime_profile` is set to `autotuned`, each
+model runs with the fastest settings found for it by the autotuner (`python -m satsr.benchmark autotune`), which are
+saved in `./models/<satellite>_model_<res>m/conf/runtime_profile.json`.
+"""
+
+import os
+import json
+
+from satsr import config, paths, main_sat
+
+
+# Profile keys and their corresponding environment variables (if any)
+profile_keys = {'intra_op_threads': None,
+                'inter_op_threads': None,
+                'omp_num_threads': 'OMP_NUM_THREADS',
+                'kmp_blocktime': 'KMP_BLOCKTIME',
+                'kmp_affinity': 'KMP_AFFINITY',
+                'frozen_models': None,
+                'xla_jit': None}
+
+# Settings shared by the whole process: the OpenMP/MKL variables and the threads of the default Tensorflow session. The
+# rest of the settings of each model are applied when it is loaded (see `get_model_profile()`).
+process_keys = ['intra_op_threads', 'inter_op_threads', 'omp_num_threads', 'kmp_blocktime', 'kmp_affinity', 'xla_jit']
+
+
+def get_profile_path(modelname):
+    return os.path.join(paths.get_models_dir(), modelname, 'conf', 'runtime_profile.json')
+
+
+def load_profile(modelname):
+    """
+    Load the autotuned profile of a model (None if the model has not been autotuned)
+    """
+    profile_path = get_profile_path(modelname)
+    if not os.path.isfile(profile_path):
+        return None
+    with open(profile_path, 'r') as f:
+        return json.load(f)
+
+
+def save_profile(profile, modelname):
+    with open(get_profile_path(modelname), 'w') as outfile:
+        json.dump(profile, outfile, sort_keys=True, indent=4)
+
+
+def get_runtime_profile(conf=None):
+    """
+    Get the runtime settings for the current configuration.
+
+    Returns
+    -------
+    Dict with the `profile_keys` plus a `models` dict with the autotuned settings (`profile_keys` and `batch_size`) of
+    the model of each resolution (see `get_model_profile()`). The OpenMP/MKL variables are shared by all the models of
+    the process, so those of the largest autotuned resolution (heaviest model) are used.
+    """
+    conf = config.conf_dict if conf is None else conf
+    profile = {k: conf['runtime'][k] for k in profile_keys.keys()}
+    profile['models'] = {}
+
+    if conf['runtime']['runtime_profile'] == 'autotuned':
+        resolutions = sorted(main_sat.res_to_bands().keys())
+        for res in resolutions[1:]:
+            tuned = load_profile('{}_model_{}m'.format(conf['general']['satellite'], res))
+            if tuned is None:
+                continue
+            profile['models'][res] = {k: tuned[k] for k in list(profile_keys.keys()) + ['batch_size'] if k in tuned}
+            profile.update({k: tuned[k] for k, env_var in profile_keys.items() if env_var and k in tuned})
+
+    return profile
+
+
+def get_model_profile(profile, res):
+    """
+    Runtime settings of the model of a resolution: its autotuned settings if any, otherwise those of the configuration.
+
+    Returns
+    -------
+    Dict with the `profile_keys` plus the `batch_size` (None if the model has not been autotuned)
+    """
+    model_profile = {k: profile[k] for k in profile_keys.keys()}
+    model_profile['batch_size'] = None
+    model_profile.update(profile['models'].get(res, {}))
+    return model_profile
+
+
+def set_env_vars(profile):
+    """
+    Export the OpenMP/MKL variables of the profile. Be aware that those libraries read them when they are initialized,
+    so they only have effect on processes that have not yet started Tensorflow (eg. the processes of
+    `num_processes_test` or the trials of the autotuner).
+    """
+    for k, env_var in profile_keys.items():
+        if env_var and (profile[k] is not None):
+            os.environ[env_var] = str(profile[k])
+
+
+def get_tf_config(profile):
+    """
+    Configuration of the Tensorflow sessions for a runtime profile
+    """
+    from satsr.utils.model_utils import get_tf_config as tf_config
+
+    return tf_config(intra_op=profile['intra_op_threads'] or 0,
+                     inter_op=profile['inter_op_threads'] or 0,
+                     xla=profile['xla_jit'])
+
+
+def apply_runtime_profile(profile):
+    """
+    Apply the runtime profile to the current process. This creates a new Tensorflow session so it must be called before
+    building the models.
+    """
+    from keras.backend.tensorflow_backend import set_session
+    import tensorflow as tf
+
+    set_env_vars(profile)
+    set_session(tf.Session(config=get_tf_config(profile)))
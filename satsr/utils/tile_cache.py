@@ -0,0 +1,283 @@
+"""
+Persistent cache of the input tiles.
+
+Tiles are kept in `./data/test/cache/tiles/<checksum>/` where the checksum is the one of the compressed archive:
+* `extracted/` holds the extracted files, so the archive is only extracted once,
+* `decoded/` (optional) holds the bands of the whole tile decoded into `.npy` files, so the region of interest of later
+  requests is read from them with memory mapping instead of decoding the JP2/HDF files again.
+The urls of the downloaded archives are also indexed, so that requests for the same url skip the download as long as
+the headers of the server (ETag, Last-Modified, Content-Length) do not change.
+
+When the cache grows larger than its size limit, the least recently used tiles are removed, except the ones that are
+being used by a request (see `get_tile()` and `release_tile()`).
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+import numpy as np
+
+from satsr import paths, main_sat
+from satsr.utils import misc
+
+
+lock = threading.RLock()
+
+# Number of requests using each tile (they are not removed from the cache until released)
+in_use = {}
+
+
+class TileNotCached(Exception):
+    pass
+
+
+def get_cache_dir():
+    return os.path.join(paths.get_test_dir(), 'cache', 'tiles')
+
+
+def get_entry_dir(checksum):
+    return os.path.join(get_cache_dir(), checksum)
+
+
+# Urls
+# ----
+
+def get_url_index_path():
+    return os.path.join(get_cache_dir(), 'urls.json')
+
+
+def get_url_version(headers):
+    return {k: headers.get(k) for k in ['ETag', 'Last-Modified', 'Content-Length']}
+
+
+def lookup_url(url, headers):
+    """
+    Checksum of the archive of an url if it is in the cache and has not changed on the server (None otherwise)
+    """
+    with lock:
+        index_path = get_url_index_path()
+        if not os.path.isfile(index_path):
+            return None
+        with open(index_path, 'r') as f:
+            entry = json.load(f).get(url)
+
+    version = get_url_version(headers)
+    if (entry is None) or (not any(version.values())) or (entry['version'] != version):
+        return None
+    if not os.path.isdir(get_entry_dir(entry['checksum'])):
+        return None
+    return entry['checksum']
+
+
+def register_url(url, headers, checksum):
+    with lock:
+        index_path = get_url_index_path()
+        index = {}
+        if os.path.isfile(index_path):
+            with open(index_path, 'r') as f:
+                index = json.load(f)
+        index[url] = {'checksum': checksum, 'version': get_url_version(headers)}
+        with open(index_path, 'w') as outfile:
+            json.dump(index, outfile, sort_keys=True, indent=4)
+
+
+# Tiles
+# -----
+
+def lookup_tile(checksum):
+    """
+    Path of the extracted tile of an archive (None if it is not in the cache)
+    """
+    meta_path = os.path.join(get_entry_dir(checksum), 'tile.json')
+    if not os.path.isfile(meta_path):
+        return None
+    with open(meta_path, 'r') as f:
+        tile_name = json.load(f)['tile_name']
+    os.utime(get_entry_dir(checksum))  # mark the entry as recently used
+    return os.path.join(get_entry_dir(checksum), 'extracted', tile_name)
+
+
+def acquire_tile(checksum):
+    """
+    Path of the extracted tile of an archive (None if it is not in the cache). The tile is marked as in use so that it
+    is not removed from the cache until it is released.
+    """
+    with lock:
+        tile_path = lookup_tile(checksum)
+        if tile_path is not None:
+            in_use[checksum] = in_use.get(checksum, 0) + 1
+        return tile_path
+
+
+def release_tile(checksum):
+    with lock:
+        in_use[checksum] -= 1
+        if not in_use[checksum]:
+            del in_use[checksum]
+
+
+def get_tile(byte_stream, file_format, checksum, max_size=10240):
+    """
+    Get the extracted tile of an archive, extracting it in the cache if it is not already there. The tile must be
+    released with `release_tile()` once it is no longer used.
+
+    Parameters
+    ----------
+    byte_stream : BinaryIO
+        Compressed tile. It can be None if the tile is expected to be in the cache, `TileNotCached` is raised if it
+        isn't (eg. because it has been removed meanwhile).
+    file_format : str
+        See `misc.open_compressed()`
+    checksum : str
+        Checksum of the archive
+    max_size : int
+        Size of the cache (in MB)
+
+    Returns
+    -------
+    Path of the extracted tile
+    """
+    tile_path = acquire_tile(checksum)
+    if tile_path is not None:
+        return tile_path
+    if byte_stream is None:
+        raise TileNotCached('The tile {} is not in the cache'.format(checksum))
+
+    # Extract to a temporary folder first so that a half-extracted tile is never used
+    cache_dir = get_cache_dir()
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=cache_dir, prefix='.tmp_')
+    try:
+        tile_path = misc.open_compressed(byte_stream=byte_stream,
+                                         file_format=file_format,
+                                         output_folder=os.path.join(tmp_dir, 'extracted'))
+        with open(os.path.join(tmp_dir, 'tile.json'), 'w') as outfile:
+            json.dump({'tile_name': os.path.basename(tile_path)}, outfile)
+        with lock:  # the tile is marked as in use before any eviction can see it
+            try:
+                os.rename(tmp_dir, get_entry_dir(checksum))
+            except OSError:  # the same tile was extracted meanwhile
+                pass
+            tile_path = acquire_tile(checksum)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    evict(max_size=max_size)
+    return tile_path
+
+
+def get_bands_dir(tile_path, max_size=None):
+    """
+    Folder for the decoded bands of a cached tile. If `max_size` is given, the tile is decoded if it wasn't already and
+    the cache is then shrunk to `max_size` MB, as the decoded bands count against its size.
+    """
+    bands_dir = os.path.join(os.path.dirname(os.path.dirname(tile_path)), 'decoded')
+    if max_size is not None and not os.path.isfile(os.path.join(bands_dir, 'coord.json')):
+        print('Decoding the bands of the whole tile ...')
+        decode_tile(tile_path, bands_dir)
+        evict(max_size=max_size)
+    return bands_dir
+
+
+def decode_tile(tile_path, bands_dir, strip_size=1024):
+    """
+    Decode all the bands of a tile and save them as `.npy` files (one per resolution) along with their coordinates.
+    The tile is decoded in strips of `strip_size` rows (at the minimal resolution) written straight into memory mapped
+    files, so that the memory used does not depend on the size of the tile.
+    """
+    read_fn = main_sat.read_bands()
+    max_res = max(main_sat.res_to_bands().keys())
+    mult = main_sat.upscaling_factor()[max_res]
+    strip_size = max(strip_size // mult, 1) * mult
+    _, coord = read_fn(tile_path=tile_path, max_res=max_res, load_data=False)
+
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(bands_dir), prefix='.tmp_')
+    try:
+        decoded = {}
+        for y0 in range(coord['ymin'], coord['ymax'] + 1, strip_size):
+            y1 = min(y0 + strip_size, coord['ymax'] + 1)
+            data_bands, _ = read_fn(tile_path=tile_path, max_res=max_res,
+                                    roi_x_y=[coord['xmin'], y0, coord['xmax'], y1 - 1])
+            for res, bands in data_bands.items():
+                uf = main_sat.upscaling_factor()[res]
+                if res not in decoded:
+                    shape = ((coord['ymax'] - coord['ymin'] + 1) // uf, bands.shape[1], bands.shape[2])
+                    decoded[res] = np.lib.format.open_memmap(os.path.join(tmp_dir, '{}.npy'.format(res)), mode='w+',
+                                                             dtype=bands.dtype, shape=shape)
+                decoded[res][(y0 - coord['ymin']) // uf:(y1 - coord['ymin']) // uf] = bands
+            del data_bands
+        for bands in decoded.values():
+            bands.flush()
+        decoded = None
+
+        with open(os.path.join(tmp_dir, 'coord.json'), 'w') as outfile:
+            json.dump(dict(coord, geotransform=list(coord['geotransform'])), outfile)
+        try:
+            os.rename(tmp_dir, bands_dir)
+        except OSError:
+            if not os.path.isdir(bands_dir):  # otherwise the same tile was decoded meanwhile
+                raise
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def read_bands(tile_path, max_res, roi_x_y=None, roi_lon_lat=None, bands_dir=None):
+    """
+    Same as the `read_bands()` of the satellite. If `bands_dir` is given, the whole tile is decoded the first time and
+    the region of interest is then read from the decoded bands.
+    """
+    read_fn = main_sat.read_bands()
+    if bands_dir is None:
+        return read_fn(tile_path=tile_path, max_res=max_res, roi_x_y=roi_x_y, roi_lon_lat=roi_lon_lat)
+
+    if not os.path.isfile(os.path.join(bands_dir, 'coord.json')):
+        print('Decoding the bands of the whole tile ...')
+        decode_tile(tile_path, bands_dir)
+    with open(os.path.join(bands_dir, 'coord.json'), 'r') as f:
+        tile_coord = json.load(f)
+
+    _, coord = read_fn(tile_path=tile_path, max_res=max_res, roi_x_y=roi_x_y, roi_lon_lat=roi_lon_lat,
+                       load_data=False)
+    if list(coord['geotransform']) != tile_coord['geotransform']:  # eg. another UTM zone is selected for this ROI
+        return read_fn(tile_path=tile_path, max_res=max_res, roi_x_y=roi_x_y, roi_lon_lat=roi_lon_lat)
+
+    # Same pixels as the ones read by `read_bands()`
+    data_bands = {}
+    for res, uf in main_sat.upscaling_factor().items():
+        if res > max_res:
+            continue
+        bands = np.load(os.path.join(bands_dir, '{}.npy'.format(res)), mmap_mode='r')
+        y0, x0 = (coord['ymin'] - tile_coord['ymin']) // uf, (coord['xmin'] - tile_coord['xmin']) // uf
+        y1, x1 = y0 + (coord['ymax'] - coord['ymin'] + 1) // uf, x0 + (coord['xmax'] - coord['xmin'] + 1) // uf
+        data_bands[res] = np.array(bands[y0:y1, x0:x1])  # copy, as the bands are modified during the processing
+    return data_bands, coord
+
+
+def get_dir_size(path):
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+
+
+def evict(max_size):
+    """
+    Remove the least recently used tiles until the cache is under `max_size` MB. Tiles in use are kept.
+    """
+    with lock:
+        cache_dir = get_cache_dir()
+        entries = []
+        for checksum in os.listdir(cache_dir):
+            entry_dir = os.path.join(cache_dir, checksum)
+            if checksum.startswith('.') or not os.path.isdir(entry_dir):
+                continue
+            entries.append((os.path.getmtime(entry_dir), checksum, get_dir_size(entry_dir)))
+
+        total_size = sum(e[2] for e in entries)
+        for _, checksum, size in sorted(entries):
+            if total_size <= max_size * 2**20:
+                break
+            if checksum in in_use:
+                continue
+            shutil.rmtree(os.path.join(cache_dir, checksum), ignore_errors=True)
+            total_size -= size